@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""AVP header encode: packed from the AVP's fields on every encodeInto
+against a header template pre-packed from the dictionary definition,
+copied in and patched with the length.
+
+The template loses on CPython: the slice copy plus the pack of the
+flags+length word cost more than the one pack_into of the whole header,
+so DiameterAVPDef keeps no template.
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from diameter.codec import AVP_HEADER_VENDOR, UINT32
+from diameter.protocol import DiameterAVP, PADDING
+
+
+class TemplateAVP(DiameterAVP):
+    """Header from a template, as a handle would stamp it"""
+    __slots__ = ('template', 'flag_bits')
+
+    def __init__(self, code, vendor, mandatory):
+        DiameterAVP.__init__(self, code, vendor, mandatory)
+        self.flag_bits = (0xc0 if mandatory else 0x80) << 24
+        self.template = AVP_HEADER_VENDOR.pack(code, self.flag_bits, vendor)
+
+    def encodeInto(self, buf, offset):
+        # DiameterAVP.encodeInto with the header from the template
+        length = self.avp_size + self.type_size
+        buf[offset:offset + 12] = self.template
+        UINT32.pack_into(buf, offset + 4, self.flag_bits | length)
+
+        i = offset + self.avp_size
+        if self.avp_group is not None and not self.avp_data:
+            for avp in self.avp_group:
+                i = avp.encodeInto(buf, i)
+        else:
+            buf[i:i + self.type_size] = self.avp_data
+
+        i = offset + length
+        pad = -length & 3
+        if pad:
+            buf[i:i + pad] = PADDING[pad]
+        return i + pad
+
+
+def main():
+    number = 20000
+    buf = bytearray(64)
+    packed = DiameterAVP(1032, 10415, True).withInteger32(1004)
+    template = TemplateAVP(1032, 10415, True).withInteger32(1004)
+    assert packed.getWire() == template.getWire()
+    # best of many runs, the others are mostly scheduler noise
+    a = min(timeit.repeat(lambda: packed.encodeInto(buf, 0), number=number, repeat=100)) * 1e9 / number
+    b = min(timeit.repeat(lambda: template.encodeInto(buf, 0), number=number, repeat=100)) * 1e9 / number
+    print("vendor avp encode  packed %8.1f ns  template %8.1f ns  speedup %.2fx" % (a, b, a / b))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Lookup cost versus AVP count.
+
+Builds messages with a growing number of Multiple-Services-Credit-Control
+AVPs, parses them back and times findFirstAVP/findAVP through the
+(code, vendor) index against a plain linear scan of the same group.
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from diameter.protocol import DiameterAVP, DiameterMessage
+
+
+def build_ccr(mscc_count):
+    msg = DiameterMessage()
+    msg.request_flag = True
+    msg.application_id = 4
+    msg.command_code = 272
+    session = DiameterAVP()
+    session.setCode(263)
+    session.setOctetString("client.example.com;1;1")
+    msg.addAVP(session)
+    for n in range(mscc_count):
+        mscc = DiameterAVP()
+        mscc.setCode(456)
+        rg = DiameterAVP()
+        rg.setCode(432)
+        rg.setInteger32(n)
+        mscc.addAVP(rg)
+        msg.addAVP(mscc)
+    result = DiameterAVP()
+    result.setCode(268)
+    result.setInteger32(2001)
+    msg.addAVP(result)
+    return msg.getWire()
+
+
+def linear_find(group, code, vendor=0):
+    return [avp for avp in group if avp.avp_code == code and avp.avp_vendor == vendor]
+
+
+def main():
+    number = 20000
+    print("%6s %14s %14s %14s" % ("avps", "linear us", "findFirst us", "findAVP us"))
+    for count in (10, 50, 100, 200):
+        msg = DiameterMessage()
+        msg.parseFromBuffer(build_ccr(count))
+        group = msg.getGroup()
+
+        linear = timeit.timeit(lambda: linear_find(group, 268), number=number)
+        first = timeit.timeit(lambda: msg.findFirstAVP(268), number=number)
+        every = timeit.timeit(lambda: msg.findAVP(456), number=number)
+        print("%6d %14.3f %14.3f %14.3f" % (len(group),
+                                            linear * 1e6 / number,
+                                            first * 1e6 / number,
+                                            every * 1e6 / number))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Memory held per parsed message and per AVP.
+
+Parses a corpus of messages, keeps every one of them alive with all of its
+AVPs (grouped ones included) opened and reports the bytes reachable from
+the message objects. Pass files holding raw captured Diameter messages
+(concatenated wire format) to measure them instead of the generated corpus.
+"""
+from __future__ import print_function
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from diameter.protocol import DiameterAVP, DiameterMessage
+from bench_lookup import build_ccr
+
+
+def deep_size(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += deep_size(item, seen)
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (DiameterAVP, DiameterMessage)):
+        if hasattr(obj, '__dict__'):
+            size += deep_size(obj.__dict__, seen)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(obj, name):
+                    size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+def open_groups(avps):
+    count = 0
+    for avp in avps:
+        count += 1
+        if avp.avp_code == 456:
+            count += open_groups(avp.getGroup())
+    return count
+
+
+def split_wire(data):
+    offset = 0
+    while offset + 20 <= len(data):
+        msg = DiameterMessage()
+        offset += msg.parseFromBuffer(data, offset)
+        yield msg
+
+
+def main():
+    if len(sys.argv) > 1:
+        messages = []
+        for name in sys.argv[1:]:
+            with open(name, 'rb') as f:
+                messages.extend(split_wire(f.read()))
+    else:
+        messages = []
+        for count in (2, 5, 10, 20, 50):
+            for n in range(200):
+                msg = DiameterMessage()
+                msg.parseFromBuffer(build_ccr(count))
+                messages.append(msg)
+
+    avps = sum(open_groups(msg.getGroup()) for msg in messages)
+    seen = set()
+    # shared constants are not per-message cost
+    seen.add(id(""))
+    total = sum(deep_size(msg, seen) for msg in messages)
+    print("messages %d avps %d" % (len(messages), avps))
+    print("bytes total %d" % total)
+    print("bytes per message %.1f" % (float(total) / len(messages)))
+    print("bytes per avp %.1f" % (float(total) / avps))
+    print("avp instance %d bytes, message instance %d bytes" % (
+        sys.getsizeof(DiameterAVP()), sys.getsizeof(DiameterMessage())))
+
+
+if __name__ == "__main__":
+    main()
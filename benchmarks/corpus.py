@@ -0,0 +1,113 @@
+"""Generated corpus of realistic messages for the benchmarks.
+
+Every message comes from a Stack with fixed identity and ids, so the
+corpus is byte for byte the same on every run: a CER, a DWR, Gy CCRs
+(initial, then updates with 1, 5 and 20 Multiple-Services-Credit-Control
+AVPs) and the CCAs answering them.
+"""
+from __future__ import print_function
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from diameter import stack
+from diameter.ids import Identifiers
+from diameter.protocol import DiameterAVP
+
+GY = 4
+CCR = 272
+VENDOR_3GPP = 10415
+# name -> Multiple-Services-Credit-Control AVPs of the CCR
+CCR_SIZES = (("ccr-initial", 0), ("ccr-update-1", 1), ("ccr-update-5", 5), ("ccr-update-20", 20))
+
+
+def newStack(identity="client.bench.example", realm="bench.example"):
+    s = stack.Stack()
+    s.identity = identity
+    s.realm = realm
+    s.addSupportedVendor(VENDOR_3GPP)
+    s.host_addresses = ["127.0.0.1"]
+    s.end_to_end = Identifiers(1)
+    return s
+
+
+def unit(code, octets, seconds):
+    """Requested/Used/Granted-Service-Unit"""
+    return DiameterAVP(code, mandatory=True) \
+        .withAVP(DiameterAVP(420, mandatory=True).withInteger32(seconds)) \
+        .withAVP(DiameterAVP(421, mandatory=True).withInteger64(octets))
+
+
+def mscc(n, answer=False):
+    avp = DiameterAVP(456, mandatory=True)
+    avp.addAVP(DiameterAVP(432, mandatory=True).withInteger32(n))
+    avp.addAVP(DiameterAVP(439, mandatory=True).withInteger32(1000 + n))
+    if answer:
+        avp.addAVP(unit(431, 1 << 20, 3600))
+        avp.addAVP(DiameterAVP(448, mandatory=True).withInteger32(3000))
+        avp.addAVP(DiameterAVP(268, mandatory=True).withInteger32(2001))
+    else:
+        avp.addAVP(unit(437, 1 << 20, 3600))
+        avp.addAVP(unit(446, n * 4096, n * 10))
+    return avp
+
+
+def buildCCR(s, mscc_count, number=0):
+    msg = s.createRequest(GY, CCR, auth=True)
+    msg.addAVP(DiameterAVP(263, mandatory=True).withOctetString("%s;1234;%d" % (s.identity, number)))
+    msg.addAVP(DiameterAVP(283, mandatory=True).withOctetString("ocs.bench.example"))
+    msg.addAVP(DiameterAVP(461, mandatory=True).withOctetString("32251@3gpp.org"))
+    msg.addAVP(DiameterAVP(416, mandatory=True).withInteger32(2 if mscc_count else 1))
+    msg.addAVP(DiameterAVP(415, mandatory=True).withInteger32(number))
+    subscription = DiameterAVP(443, mandatory=True)
+    subscription.addAVP(DiameterAVP(450, mandatory=True).withInteger32(0))
+    subscription.addAVP(DiameterAVP(444, mandatory=True).withOctetString("79161234567"))
+    msg.addAVP(subscription)
+    msg.addAVP(DiameterAVP(455, mandatory=True).withInteger32(1))
+    for n in range(mscc_count):
+        msg.addAVP(mscc(n))
+    return msg
+
+
+def buildCCA(s, ccr):
+    msg = s.createAnswer(ccr, 2001)
+    msg.addAVP(ccr.findFirstAVP(263))
+    msg.addAVP(ccr.findFirstAVP(416))
+    msg.addAVP(ccr.findFirstAVP(415))
+    for n in range(len(ccr.findAVP(456))):
+        msg.addAVP(mscc(n, answer=True))
+    return msg
+
+
+def buildCER(s):
+    msg = s.createRequest(0, 257)
+    for avp in s.capabilitiesAVPs():
+        msg.addAVP(avp)
+    return msg
+
+
+def build(s=None):
+    """[(name, DiameterMessage)] of the corpus, built by s"""
+    if s is None:
+        s = newStack()
+    messages = [("cer", buildCER(s)), ("dwr", s.createWatchdogRequest())]
+    for name, count in CCR_SIZES:
+        ccr = buildCCR(s, count)
+        messages.append((name, ccr))
+        messages.append((name.replace("ccr", "cca"), buildCCA(s, ccr)))
+    return messages
+
+
+def wires(s=None):
+    """[(name, wire bytes)] of the corpus"""
+    return [(name, bytes(msg.getBytes())) for name, msg in build(s)]
+
+
+def main():
+    for name, wire in wires():
+        print("%-16s %6d bytes" % (name, len(wire)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""Throughput of each layer over the generated corpus.
+
+    python benchmarks/suite.py [--quick] [--json out.json] [--compare old.json]
+
+encode      DiameterMessage.getWire of every corpus message
+decode      parseFromBuffer, eager and lazy (Session-Id and Result-Code read)
+framing     Peer.feed over a stream of the whole corpus
+dispatch    Stack.handleIncomingMessage of CCRs to a registered application
+loopback    CCR/CCA over TCP between two stacks on one asyncio loop
+
+Each measurement is the best of several repeats. Allocations come from
+tracemalloc where it exists (python 3). Python 2 has no allocation
+hooks, there they are the objects a call leaves alive, its result
+included, found by diffing gc.get_objects() and sized with
+sys.getsizeof, so temporaries freed inside the call are not counted;
+allocation_source says which one was used. --json writes every result
+with the environment it was taken on, --compare prints the ratio
+against a file written earlier.
+"""
+from __future__ import print_function
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import corpus
+from diameter import peer, stack
+from diameter.protocol import DiameterMessage
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def measure(name, func, messages, number, repeat):
+    """Time number calls of func, each one handling messages messages"""
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    result = {
+        'name': name,
+        'messages': messages * number,
+        'seconds': best,
+        'messages_per_second': messages * number / best,
+        'ns_per_message': best * 1e9 / (messages * number),
+    }
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func()
+        before = tracemalloc.take_snapshot()
+        func()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = after.compare_to(before, 'filename')
+        result['allocation_source'] = 'tracemalloc'
+        result['allocated_blocks_per_message'] = float(sum(s.count_diff for s in stats if s.count_diff > 0)) / messages
+        result['allocated_bytes_per_message'] = float(sum(s.size_diff for s in stats if s.size_diff > 0)) / messages
+    else:
+        blocks, size = retained(func)
+        result['allocation_source'] = 'gc'
+        result['allocated_blocks_per_message'] = float(blocks) / messages
+        result['allocated_bytes_per_message'] = float(size) / messages
+    return result
+
+
+def retained(func, calls=50):
+    """Objects and bytes one call of func leaves alive, its result
+    included, averaged over calls calls"""
+    func()
+    gc.collect()
+    gc.disable()
+    try:
+        known = set(id(o) for o in gc.get_objects())
+        results = [func() for i in range(calls)]
+        new = [o for o in gc.get_objects() if id(o) not in known]
+    finally:
+        gc.enable()
+    new = [o for o in new if o is not results and o is not known]
+    # str, int and the like are not tracked by gc, take those the new
+    # objects and the results hold. Ones shared by every call are
+    # counted once, so constants barely show.
+    seen = set(id(o) for o in new)
+    for o in gc.get_referents(*new) + results:
+        if id(o) not in seen and not gc.is_tracked(o):
+            seen.add(id(o))
+            new.append(o)
+    return float(len(new)) / calls, float(sum(sys.getsizeof(o) for o in new)) / calls
+
+
+class NullIO(peer.PeerIOCallbacks):
+    def write(self, peer, data, length):
+        pass
+
+
+class Answering(stack.ApplicationListener):
+    """Answers every CCR with a CCA"""
+    def onRequest(self, peer, request):
+        self.stack.sendByPeer(peer, corpus.buildCCA(self.stack, request), False)
+
+
+class Counting(stack.ApplicationListener):
+    def __init__(self):
+        self.requests = 0
+
+    def onRequest(self, peer, request):
+        self.requests += 1
+
+
+def registeredPeer(s, apps):
+    p = peer.Peer(s.manager, peer.PeerStateMachine.PEER_SERVER)
+    s.registerPeer(p, "peer.bench.example", "bench.example", apps)
+    p.fsm.run = p.fsm.app_handler
+    return p
+
+
+def benchEncode(messages, number, repeat):
+    results = list()
+    for name, msg in messages:
+        results.append(measure("encode " + name, msg.getWire, 1, number, repeat))
+    return results
+
+
+def benchDecode(wires, number, repeat):
+    results = list()
+    for name, wire in wires:
+        def eager(wire=wire):
+            msg = DiameterMessage()
+            msg.parseFromBuffer(wire)
+            return msg
+
+        def lazy(wire=wire):
+            msg = DiameterMessage()
+            msg.parseFromBuffer(wire, 0, True)
+            msg.findFirstAVP(263)
+            msg.findFirstAVP(268)
+            return msg
+
+        results.append(measure("decode eager " + name, eager, 1, number, repeat))
+        results.append(measure("decode lazy " + name, lazy, 1, number, repeat))
+    return results
+
+
+def benchFraming(wires, number, repeat):
+    s = corpus.newStack()
+    s.watchdog_seconds = None
+    p = peer.Peer(s.manager, peer.PeerStateMachine.PEER_SERVER)
+    p.fsm.run = lambda consumed, msg: None
+    stream = bytearray(b"".join(wire for name, wire in wires) * 10)
+    count = len(wires) * 10
+
+    def feed():
+        p.feed(stream, len(stream))
+
+    return [measure("framing corpus stream", feed, count, max(number // count, 1), repeat)]
+
+
+def benchDispatch(wires, number, repeat):
+    s = corpus.newStack("server.bench.example")
+    s.watchdog_seconds = None
+    s.registerPeerIO(NullIO())
+    app = Counting()
+    s.registerAuthApplication(app, 0, corpus.GY)
+    p = registeredPeer(s, {(0, corpus.GY): True})
+    results = list()
+    for name, wire in wires:
+        if not name.startswith("ccr"):
+            continue
+        msg = DiameterMessage()
+        msg.parseFromBuffer(wire, 0, True)
+
+        def dispatch(msg=msg):
+            s.handleIncomingMessage(p, msg)
+
+        results.append(measure("dispatch " + name, dispatch, 1, number, repeat))
+    return results
+
+
+def benchLoopback(count, window):
+    """count CCRs, window of them in flight, client and server stacks
+    talking over localhost"""
+    try:
+        from diameter import aio
+    except ImportError as e:
+        print("loopback skipped: %s" % e)
+        return []
+
+    loop = aio.newEventLoop(use_uvloop=False)
+    server = corpus.newStack("server.bench.example")
+    answering = Answering()
+    answering.setStack(server)
+    server.registerAuthApplication(answering, 0, corpus.GY)
+    server_io = aio.AsyncioPeerIO(server, loop)
+    server.registerPeerIO(server_io)
+    loop.run_until_complete(server.serverV4Add("127.0.0.1", 0))
+    port = server_io.servers[0].sockets[0].getsockname()[1]
+
+    client = corpus.newStack("client.bench.example")
+    client.registerAuthApplication(Counting(), 0, corpus.GY)
+    client_io = aio.AsyncioPeerIO(client, loop)
+    client.registerPeerIO(client_io)
+    done = client.future_factory()
+    state = {'sent': 0, 'answered': 0, 'started': None}
+
+    def answered(answer):
+        state['answered'] += 1
+        if state['answered'] == count:
+            done.set_result(time.time() - state['started'])
+        elif state['sent'] < count:
+            send(answer_peer[0])
+
+    def failed(error):
+        if not done.done():
+            done.set_exception(error)
+
+    def send(p):
+        state['sent'] += 1
+        client.sendRequestCallback(p, corpus.buildCCR(client, 5, state['sent']), answered, failed)
+
+    answer_peer = []
+
+    class Start(stack.PeerListener):
+        def connected(self, p):
+            answer_peer.append(p)
+            state['started'] = time.time()
+            for i in range(min(window, count)):
+                send(p)
+
+    client.registerPeerListener(Start())
+    server_io.start()
+    client_io.start()
+    client.clientV4Add("127.0.0.1", port)
+    seconds = loop.run_until_complete(done)
+    client_io.stop()
+    server_io.stop()
+    # let the transports close
+    loop.call_later(0.1, loop.stop)
+    loop.run_forever()
+    loop.close()
+    return [{
+        'name': "loopback ccr-update-5 window %d" % window,
+        'messages': count,
+        'seconds': seconds,
+        'messages_per_second': count / seconds,
+        'ns_per_message': seconds * 1e9 / count,
+    }]
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(results, old_file):
+    with open(old_file) as f:
+        old = dict((r['name'], r) for r in json.load(f)['results'])
+    print()
+    print("%-40s %14s %14s %8s" % ("compared to " + old_file, "old msg/s", "new msg/s", "ratio"))
+    for r in results:
+        before = old.get(r['name'])
+        if before is None:
+            continue
+        print("%-40s %14.0f %14.0f %8.2f" % (r['name'], before['messages_per_second'],
+                                            r['messages_per_second'],
+                                            r['messages_per_second'] / before['messages_per_second']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, for a smoke run")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run")
+    parser.add_argument("--no-loopback", action="store_true")
+    args = parser.parse_args()
+
+    number, repeat, loopback = 2000, 5, 5000
+    if args.quick:
+        number, repeat, loopback = 200, 2, 500
+
+    messages = corpus.build()
+    wires = [(name, bytes(msg.getBytes())) for name, msg in messages]
+    results = list()
+    results += benchEncode(messages, number, repeat)
+    results += benchDecode(wires, number, repeat)
+    results += benchFraming(wires, number, repeat)
+    results += benchDispatch(wires, number, repeat)
+    if not args.no_loopback:
+        results += benchLoopback(loopback, 32)
+
+    print("%-40s %14s %12s" % ("benchmark", "msg/s", "ns/msg"))
+    for r in results:
+        print("%-40s %14.0f %12.0f" % (r['name'], r['messages_per_second'], r['ns_per_message']))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""asyncio transport for the stack
+
+    loop = aio.newEventLoop()
+    io = aio.AsyncioPeerIO(dstack, loop)
+    dstack.registerPeerIO(io)
+    dstack.clientV4Add("127.0.0.1", 3868)
+    io.start()
+    loop.run_forever()
+
+Once the stack is bound to the loop Stack.sendRequest returns asyncio
+futures, from a trollius coroutine:
+
+    answer = yield From(dstack.sendRequest(peer, ccr, timeout=5))
+
+trollius stands in for asyncio on python 2, install it with the aio
+extra. uvloop only exists for python 3, which the package doesn't run
+on yet, newEventLoop(use_uvloop=True) falls back to the default loop
+without it.
+"""
+import logging
+import socket
+import threading
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from diameter.peer import PeerIOCallbacks
+from diameter.resolver import resolver
+
+_log = logging.getLogger("sdp.diameter.aio")
+
+ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+
+
+def newEventLoop(use_uvloop=False):
+    """New event loop, uvloop's when use_uvloop is set and it is installed"""
+    if use_uvloop:
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            _log.debug("uvloop not available, using the default event loop")
+    return asyncio.new_event_loop()
+
+
+def reusePortSocket(host, port, backlog=100):
+    """Listening socket other processes can bind to as well, the kernel
+    balances connections between them"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class DiameterProtocol(asyncio.Protocol):
+    def __init__(self, io, peer):
+        self.io = io
+        self.peer = peer
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        peername = transport.get_extra_info('peername')
+        if peername:
+            self.peer.ipv4, self.peer.port = peername[0], peername[1]
+        self.io.protocols[self.peer] = self
+        stack = self.io.stack
+        transport.set_write_buffer_limits(stack.send_high_watermark, stack.send_low_watermark)
+        self.peer.feed(None, 0)
+
+    def data_received(self, data):
+        if self.peer.receive(data) < 0:
+            _log.error("Protocol error from peer %s, disconnecting", self.peer)
+            self.transport.close()
+
+    def pause_writing(self):
+        self.io.stack.manager.pauseWriting(self.peer)
+
+    def resume_writing(self):
+        self.io.stack.manager.resumeWriting(self.peer)
+
+    def connection_lost(self, exc):
+        _log.info("Connection to peer %s lost: %s", self.peer, exc)
+        self.io.connectionLost(self.peer)
+
+
+class AsyncioPeerIO(PeerIOCallbacks):
+    def __init__(self, stack, loop=None, tick_interval=1, reconnect_delay=10, reuse_port=False):
+        self.stack = stack
+        self.loop = loop or asyncio.get_event_loop()
+        self.tick_interval = tick_interval
+        self.reconnect_delay = reconnect_delay
+        # listen with SO_REUSEPORT, for worker processes sharing a port
+        self.reuse_port = reuse_port
+        # peer -> DiameterProtocol of its connection
+        self.protocols = dict()
+        # client peer -> (host, port) to reconnect to
+        self.clients = dict()
+        self.servers = list()
+        self.tick_handle = None
+        # loop handle running the timers at their next deadline
+        self.timer_handle = None
+        self.timer_deadline = None
+        # peers with queued messages, written at the end of the iteration
+        self.dirty = list()
+        stack.future_factory = getattr(self.loop, 'create_future', None) or \
+            (lambda: asyncio.Future(loop=self.loop))
+
+    def start(self):
+        """Run Stack.tick every tick_interval seconds on the loop, which
+        must run on the calling thread. Timers run at their deadline."""
+        self.stack.io_thread = threading.current_thread()
+        resolver.io_thread = self.stack.io_thread
+        self.stack.prefetchAddresses()
+        self.stack.timers.wakeup = self.armTimers
+        self.armTimers()
+        if self.tick_handle is None:
+            self.tick_handle = self.loop.call_later(self.tick_interval, self.tick)
+
+    def stop(self):
+        if self.tick_handle is not None:
+            self.tick_handle.cancel()
+            self.tick_handle = None
+        self.stack.timers.wakeup = None
+        if resolver.io_thread is self.stack.io_thread:
+            resolver.io_thread = None
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+        self.clients.clear()
+        for server in self.servers:
+            server.close()
+        for protocol in list(self.protocols.values()):
+            protocol.transport.close()
+
+    def tick(self):
+        self.tick_handle = self.loop.call_later(self.tick_interval, self.tick)
+        try:
+            self.stack.tick()
+        except Exception:
+            _log.exception("Stack tick failed")
+
+    def armTimers(self, deadline=None):
+        """Have the loop run the timers at deadline, the next one queued
+        by default, unless it is already woken up earlier"""
+        timers = self.stack.timers
+        if deadline is None:
+            deadline = timers.nextDeadline()
+            if deadline is None:
+                return
+        if self.timer_handle is not None:
+            if self.timer_deadline <= deadline:
+                return
+            self.timer_handle.cancel()
+        self.timer_deadline = deadline
+        # the timer clock and the loop's may differ, convert through now
+        when = self.loop.time() + deadline - timers.clock()
+        self.timer_handle = self.loop.call_at(when, self.runTimers)
+
+    def runTimers(self):
+        self.timer_handle = None
+        try:
+            self.stack.timers.run()
+        except Exception:
+            _log.exception("Timers failed")
+        self.armTimers()
+
+    def connectV4(self, peer, host, port):
+        self.clients[peer] = (host, port)
+        _log.info("Connecting to %s:%d", host, port)
+        future = ensure_future(self.loop.create_connection(
+            lambda: DiameterProtocol(self, peer), host, port), loop=self.loop)
+        future.add_done_callback(lambda f: self.connectDone(f, peer))
+        return future
+
+    def connectDone(self, future, peer):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            _log.error("Connection to peer %s failed: %s", peer, future.exception())
+            self.reconnect(peer)
+
+    def reconnect(self, peer):
+        """Connect again to a lost or refused client peer with a fresh
+        Peer, so the capabilities exchange starts over"""
+        address = self.clients.pop(peer, None)
+        if address is not None and self.reconnect_delay is not None:
+            self.loop.call_later(self.reconnect_delay, self.stack.clientV4Add, *address)
+
+    def listenV4(self, peer, host, port, **kwargs):
+        """Extra keyword arguments go to loop.create_server"""
+        _log.info("Listening on %s:%d", host, port)
+
+        def accept():
+            return DiameterProtocol(self, self.stack.serverV4Accept(peer, host, port))
+
+        if self.reuse_port:
+            server = self.loop.create_server(accept, sock=reusePortSocket(host, port), **kwargs)
+        else:
+            server = self.loop.create_server(accept, host, port, **kwargs)
+        future = ensure_future(server, loop=self.loop)
+        future.add_done_callback(self.listenDone)
+        return future
+
+    def listenDone(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.servers.append(future.result())
+        elif not future.cancelled():
+            _log.error("Listening failed: %s", future.exception())
+
+    def connectionLost(self, peer):
+        self.protocols.pop(peer, None)
+        self.stack.connectionLost(peer)
+        peer.destroy()
+        self.reconnect(peer)
+
+    def callSoon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def flushLater(self, peer):
+        if not self.dirty:
+            self.loop.call_soon(self.flushDirty)
+        self.dirty.append(peer)
+
+    def flushDirty(self):
+        dirty = self.dirty
+        self.dirty = list()
+        for peer in dirty:
+            self.stack.manager.flush(peer)
+
+    def write(self, peer, data, length):
+        protocol = self.protocols.get(peer)
+        if protocol is None:
+            _log.error("Write to disconnected peer %s dropped", peer)
+            return
+        protocol.transport.write(data)
+
+    def close(self, peer):
+        self.clients.pop(peer, None)
+        protocol = self.protocols.get(peer)
+        if protocol is not None:
+            protocol.transport.close()
+
+    def abort(self, peer):
+        protocol = self.protocols.get(peer)
+        if protocol is not None:
+            protocol.transport.abort()
@@ -1,5 +1,19 @@
-from xml.dom.minidom import parse, parseString
+import xml.sax
+import xml.sax.handler
+import hashlib
+import logging
+import os
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
 import diameter
+from diameter.codec import findCodec, DEFAULT_CODEC
+
+_log = logging.getLogger("sdp.diameter.dictionary")
+
+# bump when the pickled layout of the definitions changes
+CACHE_VERSION = 2
 
 class DiameterCommandDef:
   def __init__(self):
@@ -14,9 +28,39 @@ class DiameterAVPDef:
     self.protected_flag = False
     self.vendor_id = 0
     self.code = 0
+    self.type_name = None
+    self.codec = DEFAULT_CODEC
     self.enum_names = {}
     self.enum_vals = {}
 
+  def __getstate__(self):
+    # codecs are shared objects, pickle them by name
+    state = self.__dict__.copy()
+    state['codec'] = self.codec.name
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.codec = findCodec(state['codec'])
+
+  def newAVP(self):
+    """New empty AVP with this definition's code, vendor, flags and codec"""
+    return diameter.protocol.DiameterAVP(self.code, self.vendor_id, self.mandatory_flag,
+                                         self.protected_flag, self.codec)
+
+  def find(self, message_or_avp):
+    """All the AVPs of this definition in message_or_avp"""
+    ret = message_or_avp.findAVP(self.code, self.vendor_id)
+    for avp in ret:
+      avp.codec = self.codec
+    return ret
+
+  def findFirst(self, message_or_avp):
+    avp = message_or_avp.findFirstAVP(self.code, self.vendor_id)
+    if avp is not None:
+      avp.codec = self.codec
+    return avp
+
   def addEnum(self, name, val):
     self.enum_names[name] = int(val)
     self.enum_vals[int(val)] = name
@@ -34,48 +78,168 @@ class DiameterAVPDef:
         return 0
 
 
+# stands in for names missing from the dictionary
+UNKNOWN_AVP_DEF = DiameterAVPDef()
+
+
+class DictionaryHandler(xml.sax.handler.ContentHandler):
+  """Streams the dictionary XML into command and avp definitions.
+  Vendor names are resolved once the whole file has been read."""
+  def __init__(self):
+    xml.sax.handler.ContentHandler.__init__(self)
+    self.vendors = {}
+    # typedefn name -> parent type name
+    self.types = {}
+    self.commands = []
+    self.avps = []
+    self.path = []
+    self.application_id = 0
+    self.avp = None
+
+  def startElement(self, name, attrs):
+    parent = self.path and self.path[-1] or None
+    self.path.append(name)
+    if name == 'vendor':
+      self.vendors[attrs['vendor-id']] = int(attrs['code'])
+    elif name == 'application':
+      self.application_id = int(attrs['id'])
+    elif name == 'command':
+      newCmd = DiameterCommandDef()
+      if parent == 'application':
+        newCmd.application_id = self.application_id
+      newCmd.code = int(attrs['code'])
+      self.commands.append((attrs['name'], attrs['vendor-id'], newCmd))
+    elif name == 'avp':
+      newAVP = DiameterAVPDef()
+      if attrs.get('mandatory') == "must":
+        newAVP.mandatory_flag=True
+      if attrs.get('protected') == "must":
+        newAVP.protected_flag=True
+      newAVP.code = int(attrs['code'])
+      self.avp = (attrs['name'], attrs.get('vendor-id'), newAVP)
+      self.avps.append(self.avp)
+    elif name == 'typedefn':
+      self.types[attrs['type-name']] = attrs.get('type-parent')
+    elif name == 'type' and self.avp:
+      self.avp[2].type_name = attrs['type-name']
+    elif name == 'grouped' and self.avp:
+      self.avp[2].type_name = "Grouped"
+    elif name == 'enum' and self.avp:
+      self.avp[2].addEnum(attrs['name'], attrs['code'])
+
+  def endElement(self, name):
+    self.path.pop()
+    if name == 'avp':
+      self.avp = None
+
+
+def isPath(file):
+  try:
+    return isinstance(file, basestring)
+  except NameError:
+    return isinstance(file, str)
+
+
 class DiameterDictionary:
-  def __init__(self,file):
-    self.dom = parse(file)
-    self.load()
-  def load(self):
+  def __init__(self, file, cache=False):
+    """file is the dictionary XML, a path or a file object. With cache
+    set and a path given, the compiled definitions are kept in
+    file.cache and reused while file doesn't change."""
+    self.name_to_cmd = {}
+    self.name_to_def = {}
+    self.def_to_name = {}
+    cache = cache and isPath(file)
+    if cache and self.loadCache(file):
+      return
+    self.load(file)
+    if cache:
+      self.saveCache(file)
+
+  def load(self, file):
     """We only load avps for now
     Add vendors and commands"""
+    handler = DictionaryHandler()
+    parser = xml.sax.make_parser()
+    # external entities are skipped, as minidom did
+    parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    parser.setContentHandler(handler)
+    parser.parse(file)
+    vendors = handler.vendors
+
     self.name_to_cmd = {}
     self.name_to_def = {}
     self.def_to_name = {}
 
-    vlist = self.dom.getElementsByTagName('vendor')
-    vendors = {}
-    for vendor in vlist:
-      vendors[vendor.attributes['vendor-id'].value] = int(vendor.attributes['code'].value)
+    for name, vendor, newCmd in handler.commands:
+      newCmd.vendor_id = vendors[vendor]
+      self.name_to_cmd[name] = newCmd
 
-    cmds = self.dom.getElementsByTagName("command")
-    for cmd in cmds:
-      newCmd = DiameterCommandDef()
-      if cmd.parentNode.nodeName == "application":
-        newCmd.application_id = int(cmd.parentNode.attributes['id'].value)
-      newCmd.vendor_id = vendors[cmd.attributes['vendor-id'].value]
-      newCmd.code = int(cmd.attributes['code'].value)
-      self.name_to_cmd[cmd.attributes['name'].value] = newCmd
-
-    avps = self.dom.getElementsByTagName("avp")
-    for avp in avps:
-      newAVP = DiameterAVPDef()
-      if avp.attributes.has_key('mandatory') and avp.attributes['mandatory'].value == "must":
-        newAVP.mandatory_flag=True
-      if avp.attributes.has_key('protected') and avp.attributes['protected'].value == "must":
-        newAVP.mandatory_flag=True
-      newAVP.code = int(avp.attributes['code'].value)
-      if avp.attributes.has_key('vendor-id'):
-        newAVP.vendor_id = vendors[avp.attributes['vendor-id'].value]
-      #parse enums
-      enums = avp.getElementsByTagName("enum")
-      for e in enums:
-          newAVP.addEnum(e.attributes['name'].value, e.attributes['code'].value)
-      self.name_to_def[avp.attributes['name'].value] = newAVP
+    for name, vendor, newAVP in handler.avps:
+      if vendor is not None:
+        newAVP.vendor_id = vendors[vendor]
+      newAVP.codec = findCodec(newAVP.type_name, handler.types)
+      self.name_to_def[name] = newAVP
       self.def_to_name[(newAVP.vendor_id,newAVP.code)] = newAVP
 
+  def cacheKey(self, file):
+    st = os.stat(file)
+    return (CACHE_VERSION, st.st_mtime, st.st_size)
+
+  def sourceHash(self, file):
+    with open(file, 'rb') as f:
+      return hashlib.sha1(f.read()).hexdigest()
+
+  def loadCache(self, file):
+    """Load the compiled definitions of file, False if there is no
+    usable cache. A touched but unchanged file is matched by its hash."""
+    try:
+      with self.openCache(file) as f:
+        if not self.trustedCache(f):
+          _log.warning("Ignoring dictionary cache %s.cache, not owned by us or writable by others", file)
+          return False
+        key, digest = pickle.load(f)
+        if key[0] != CACHE_VERSION:
+          return False
+        touched = key != self.cacheKey(file)
+        if touched and digest != self.sourceHash(file):
+          return False
+        self.name_to_cmd, self.name_to_def, self.def_to_name = pickle.load(f)
+      if touched:
+        self.saveCache(file)
+    except (IOError, OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+      return False
+    except Exception:
+      _log.exception("Ignoring unreadable dictionary cache for %s", file)
+      return False
+    _log.debug("Loaded dictionary %s from cache", file)
+    return True
+
+  def openCache(self, file):
+    # a symlink could point at a file we own but didn't write
+    fd = os.open(file + ".cache", os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+    return os.fdopen(fd, 'rb')
+
+  def trustedCache(self, f):
+    """Unpickling runs code, only caches written by this user qualify"""
+    st = os.fstat(f.fileno())
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+      return False
+    return not st.st_mode & 0o022
+
+  def saveCache(self, file):
+    tmp = "%s.cache.%d" % (file, os.getpid())
+    try:
+      with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+        pickle.dump((self.cacheKey(file), self.sourceHash(file)), f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump((self.name_to_cmd, self.name_to_def, self.def_to_name), f, pickle.HIGHEST_PROTOCOL)
+      os.rename(tmp, file + ".cache")
+    except (IOError, OSError):
+      _log.warning("Could not write dictionary cache for %s", file)
+      try:
+        os.unlink(tmp)
+      except OSError:
+        pass
+
   def getEnumCode(self, avp, name):
       d = self.getAVPDefinition(avp)
       return d.getEnumValue(name)
@@ -98,27 +262,20 @@ class DiameterDictionary:
       return stack.createRequest(cmd_def.application_id, cmd_def.code, auth, acct, vendor_id=cmd_def.vendor_id)
      
   def getAVPDefinition(self, name):
-    if self.name_to_def.has_key(name):
-      return self.name_to_def[name]
-    else:
-      return None
+    return self.name_to_def.get(name)
+
+  def getAVPHandle(self, name):
+    """Definition of name for use in hot paths, hold on to it and call
+    newAVP/find/findFirst on it instead of passing the name around.
+    Raises KeyError for names missing from the dictionary."""
+    return self.name_to_def[name]
 
   def getAVPCode(self,name):
-      avp_def = self.getAVPDefinition(name)
-      if avp_def == None:
-          avp_def = DiameterAVPDef()
+      avp_def = self.name_to_def.get(name, UNKNOWN_AVP_DEF)
       return (avp_def.code,avp_def.vendor_id)
 
   def getAVP(self, name):
-      avp_def = self.getAVPDefinition(name)
-      if avp_def == None:
-          avp_def = DiameterAVPDef()
-      ret = diameter.protocol.DiameterAVP()
-      ret.setCode(avp_def.code)
-      ret.setVendor(avp_def.vendor_id)
-      ret.setMandatory(avp_def.mandatory_flag)
-      ret.setProtected(avp_def.protected_flag)
-      return ret
+      return self.name_to_def.get(name, UNKNOWN_AVP_DEF).newAVP()
 
   def isCommand(self, message, name):
       cmd_def = self.getCommandDefinition(name)
@@ -129,7 +286,7 @@ class DiameterDictionary:
   def findAVP(self, message_or_avp, name):
       avp_def = self.getAVPDefinition(name)
       if avp_def:
-          return message_or_avp.findAVP(avp_def.code, avp_def.vendor_id)
+          return avp_def.find(message_or_avp)
       else:
           return None
 
@@ -137,10 +294,14 @@ class DiameterDictionary:
       for name in names:
           avp_def = self.getAVPDefinition(name)
           if avp_def:
-              message_or_avp = message_or_avp.findFirstAVP(avp_def.code, avp_def.vendor_id)
+              message_or_avp = avp_def.findFirst(message_or_avp)
               if message_or_avp == None:
                   return None
           else:
               return None
       return message_or_avp
 
+
+
+# imported last, protocol imports this module
+import diameter.protocol
@@ -0,0 +1,176 @@
+"""Where ApplicationListener.onRequest/onAnswer run
+
+Each registered application has a dispatcher, InlineDispatcher calls it
+on the I/O thread. ThreadDispatcher and ProcessDispatcher keep slow
+handlers off it, messages of one Session-Id are always handled by the
+same worker so they stay in order:
+
+    dstack.registerAuthApplication(ocs, 0, 4, ThreadDispatcher(8))
+
+Stack.sendByPeer and Stack.sendRequestCallback may be called from the
+worker threads, they hand the message over to the I/O thread. That takes
+a transport which sets Stack.io_thread and implements callSoon, as
+diameter.aio does, the other dispatchers refuse to run without one.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from diameter.protocol import DiameterMessage
+
+_log = logging.getLogger("sdp.diameter.dispatch")
+
+
+def sessionKey(message):
+    """Session-Id of message, its hop-by-hop id when it has none"""
+    avp = message.findFirstAVP(263)
+    if avp is None:
+        return message.hBh
+    return avp.getOctetString()
+
+
+def callApplication(app, peer, message):
+    if message.request_flag:
+        app.onRequest(peer, message)
+    else:
+        app.onAnswer(peer, message)
+
+
+def checkIOThread(stack, dispatcher):
+    if stack.io_thread is None:
+        raise RuntimeError("%s calls the stack from other threads, its transport must set "
+                           "Stack.io_thread and implement callSoon" % dispatcher.__class__.__name__)
+
+
+class InlineDispatcher:
+    def setStack(self, stack):
+        pass
+
+    def dispatch(self, app, peer, message):
+        callApplication(app, peer, message)
+
+    def close(self):
+        pass
+
+
+class ThreadDispatcher:
+    """Calls the application on one of workers threads.
+
+    The threads start with the first message, in every process: a forked
+    worker has none of the threads of its parent."""
+    def __init__(self, workers=4):
+        self.stack = None
+        self.workers = workers
+        # process the threads were started in
+        self.pid = None
+        self.queues = list()
+        self.threads = list()
+
+    def setStack(self, stack):
+        self.stack = stack
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queues = list()
+        self.threads = list()
+        for i in range(self.workers):
+            q = queue.Queue()
+            t = threading.Thread(target=self.work, args=(q,), name="diameter-dispatch-%d" % i)
+            t.daemon = True
+            t.start()
+            self.queues.append(q)
+            self.threads.append(t)
+
+    def dispatch(self, app, peer, message):
+        checkIOThread(self.stack, self)
+        if self.pid != os.getpid():
+            self.start()
+        self.queues[hash(sessionKey(message)) % len(self.queues)].put((app, peer, message))
+
+    def work(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            try:
+                callApplication(*item)
+            except Exception:
+                _log.exception("Application failed on message from peer %s", item[1])
+
+    def close(self):
+        """Stop the threads once they handled what they were given"""
+        if self.pid != os.getpid():
+            return
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+
+
+def runHandler(handler, wire):
+    """Process pool task: parse wire, run handler on it and return the
+    wire bytes of the message it returned, if any"""
+    try:
+        message = DiameterMessage()
+        message.parseFromBuffer(wire, 0, True)
+        reply = handler(message)
+        if reply is not None:
+            return reply.getBytes()
+    except Exception:
+        _log.exception("Handler %s failed", handler)
+    return None
+
+
+class ProcessDispatcher:
+    """Ships messages as wire bytes to workers processes.
+
+    handler(message) runs in the worker, it must be a module level
+    function. The message it returns, usually the answer, is sent back
+    to the peer the request came from. The application itself is not
+    called. The pools are created with the first message, again in a
+    forked worker, whose copies of its parent's pools have no threads."""
+    def __init__(self, handler, workers=2):
+        self.handler = handler
+        self.stack = None
+        self.workers = workers
+        # process the pools were created in
+        self.pid = None
+        self.pools = list()
+
+    def setStack(self, stack):
+        self.stack = stack
+
+    def start(self):
+        self.pid = os.getpid()
+        # a single process each, so tasks given to one run in order
+        self.pools = [multiprocessing.Pool(1) for i in range(self.workers)]
+
+    def dispatch(self, app, peer, message):
+        checkIOThread(self.stack, self)
+        if self.pid != os.getpid():
+            self.start()
+        pool = self.pools[hash(sessionKey(message)) % len(self.pools)]
+        pool.apply_async(runHandler, (self.handler, message.getBytes()),
+                         callback=lambda wire: self.reply(peer, wire))
+
+    def reply(self, peer, wire):
+        """Runs on the pool's result thread"""
+        if wire is None:
+            return
+        message = DiameterMessage()
+        message.parseFromBuffer(wire, 0, self.stack.lazy_decode)
+        self.stack.sendByPeer(peer, message)
+
+    def close(self):
+        if self.pid != os.getpid():
+            return
+        for pool in self.pools:
+            pool.close()
+        for pool in self.pools:
+            pool.join()
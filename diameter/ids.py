@@ -0,0 +1,38 @@
+"""Hop-by-Hop and End-to-End identifiers, RFC 6733 section 3"""
+import itertools
+import random
+import time
+
+
+class Identifiers:
+    """Increasing 32 bit ids from seed, wrapping at 2^32.
+
+    Workers sharing an identity each get their own ids: the worker index
+    takes the low worker_bits bits and the count steps over them.
+    next() is a single itertools.count step, so it is safe to call from
+    several threads without a lock."""
+    def __init__(self, seed, worker_id=0, worker_bits=0):
+        self.step = 1 << worker_bits
+        self.base = seed & ~(self.step - 1) & 0xffffffff
+        self.worker_id = worker_id
+        self.counter = itertools.count()
+
+    def next(self):
+        return (self.base + next(self.counter) * self.step + self.worker_id) & 0xffffffff
+
+    __next__ = next
+
+
+def hopByHopIds(worker_id=0, worker_bits=0):
+    """Hop-by-hop ids of one connection, from a random start"""
+    return Identifiers(random.getrandbits(32), worker_id, worker_bits)
+
+
+def endToEndIds(worker_id=0, worker_bits=0, now=None):
+    """End-to-end ids: the high 12 bits start as the low 12 bits of the
+    current time, the low 20 bits at random, so ids stay unique across a
+    restart"""
+    if now is None:
+        now = time.time()
+    seed = ((int(now) & 0xfff) << 20) | random.getrandbits(20)
+    return Identifiers(seed, worker_id, worker_bits)
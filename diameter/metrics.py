@@ -0,0 +1,218 @@
+"""Counters and latency histograms of a Stack
+
+Off unless Stack.enableMetrics is called, the hot paths only check
+stack.metrics against None then. Values are pulled with snapshot(), or
+as Prometheus style text with render(), which serve() exposes over HTTP:
+
+    metrics = dstack.enableMetrics()
+    metrics.serve(9100)
+"""
+import bisect
+import itertools
+import logging
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+_log = logging.getLogger("sdp.diameter.metrics")
+
+# seconds, upper bounds of the latency buckets
+LATENCY_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Histogram(object):
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        # the last one counts what is above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        buckets = list()
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class PeerCounters(object):
+    __slots__ = ('messages_in', 'messages_out', 'bytes_in', 'bytes_out',
+                 'parse_seconds', 'encode_seconds', 'writes', 'retransmits', 'timeouts',
+                 'connection')
+
+    def __init__(self, connection):
+        for name in PeerCounters.__slots__:
+            setattr(self, name, 0)
+        # tells apart connections of the same peer, reconnects included
+        self.connection = connection
+
+
+class ApplicationCounters(object):
+    __slots__ = ('requests_in', 'answers_in', 'latency')
+
+    def __init__(self):
+        self.requests_in = 0
+        self.answers_in = 0
+        # from the last send of our request to its answer
+        self.latency = Histogram()
+
+
+def peerLabel(peer):
+    if peer.identity is not None:
+        return peer.identity
+    return "%s:%s" % (peer.ipv4, peer.port)
+
+
+def escape(value):
+    """Label value in the Prometheus text format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    def __init__(self, stack):
+        self.stack = stack
+        # Peer -> PeerCounters, while its connection is up
+        self.peers = dict()
+        self.connections = itertools.count(1)
+        # application id -> ApplicationCounters
+        self.applications = dict()
+        self.server = None
+
+    def peer(self, peer):
+        counters = self.peers.get(peer)
+        if counters is None:
+            counters = self.peers[peer] = PeerCounters(next(self.connections))
+        return counters
+
+    def peerGone(self, peer):
+        """Forget the counters of a peer whose connection is over"""
+        self.peers.pop(peer, None)
+
+    def application(self, application_id):
+        counters = self.applications.get(application_id)
+        if counters is None:
+            counters = self.applications[application_id] = ApplicationCounters()
+        return counters
+
+    def received(self, peer, length, seconds):
+        counters = self.peer(peer)
+        counters.messages_in += 1
+        counters.bytes_in += length
+        counters.parse_seconds += seconds
+
+    def sent(self, peer, messages, length, seconds):
+        """messages written to peer at once, length bytes encoded in seconds"""
+        counters = self.peer(peer)
+        counters.messages_out += messages
+        counters.bytes_out += length
+        counters.encode_seconds += seconds
+        counters.writes += 1
+
+    def retransmitted(self, peer):
+        self.peer(peer).retransmits += 1
+
+    def timedOut(self, peer):
+        self.peer(peer).timeouts += 1
+
+    def dispatched(self, message):
+        counters = self.application(message.application_id)
+        if message.request_flag:
+            counters.requests_in += 1
+        else:
+            counters.answers_in += 1
+
+    def answered(self, request, latency):
+        self.application(request.application_id).latency.observe(latency)
+
+    def snapshot(self):
+        """Every counter and gauge as plain dicts, peers are keyed by
+        connection number and carry their label in 'peer'"""
+        stack = self.stack
+        peers = dict()
+        for peer, counters in list(self.peers.items()):
+            values = dict((name, getattr(counters, name)) for name in PeerCounters.__slots__)
+            del values['connection']
+            values['send_queue_bytes'] = peer.tx_queue.size
+            values['outstanding'] = peer.outstanding
+            values['peer'] = peerLabel(peer)
+            peers[counters.connection] = values
+        applications = dict()
+        for application_id, counters in list(self.applications.items()):
+            applications[application_id] = {
+                'requests_in': counters.requests_in,
+                'answers_in': counters.answers_in,
+                'latency': counters.latency.snapshot(),
+            }
+        stats = stack.request_stats
+        return {
+            'peers': peers,
+            'applications': applications,
+            'pending_requests': len(stack.pending),
+            'timers': len(stack.timers),
+            'sessions': len(stack.sessions) if stack.sessions is not None else 0,
+            'requests_answered': stats.answered,
+            'requests_timed_out': stats.timeouts,
+        }
+
+    def render(self):
+        """snapshot() in the Prometheus text format"""
+        snapshot = self.snapshot()
+        lines = list()
+        for connection, values in sorted(snapshot['peers'].items()):
+            label = 'peer="%s",connection="%d"' % (escape(values['peer']), connection)
+            for counter, value in sorted(values.items()):
+                if counter != 'peer':
+                    lines.append('diameter_peer_%s{%s} %s' % (counter, label, value))
+        for application_id, values in sorted(snapshot['applications'].items()):
+            label = 'application="%d"' % application_id
+            lines.append('diameter_application_requests_in{%s} %d' % (label, values['requests_in']))
+            lines.append('diameter_application_answers_in{%s} %d' % (label, values['answers_in']))
+            latency = values['latency']
+            for bound, count in latency['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('diameter_request_latency_seconds_bucket{%s,le="%s"} %d' % (label, le, count))
+            lines.append('diameter_request_latency_seconds_count{%s} %d' % (label, latency['count']))
+            lines.append('diameter_request_latency_seconds_sum{%s} %s' % (label, latency['sum']))
+        for name in ('pending_requests', 'timers', 'sessions', 'requests_answered', 'requests_timed_out'):
+            lines.append('diameter_%s %d' % (name, snapshot[name]))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Answer any GET on host:port with render(), from a thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                _log.debug(format, *args)
+
+        self.server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, name="diameter-metrics")
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -1,6 +1,10 @@
-from diameter.protocol import DiameterMessage, DiameterAVP
-import struct
+from diameter.protocol import DiameterMessage
+from diameter.codec import UINT32
+from diameter.routing import PeerList, LeastOutstanding
+from diameter.timer import now
 import logging
+import random
+import struct
 
 _log = logging.getLogger("sdp.diameter.peer")
 
@@ -24,73 +28,9 @@ class PeerStateMachine:
             self.run = None
 
     def send_cer(self, consumed, message):
-        msg = self.stack.createRequest(0, 257)
-        # vendorid
-        tmp = DiameterAVP()
-        tmp.setCode(266)
-        tmp.setMandatory(True)
-        tmp.setInteger32(self.stack.vendor_id)
-        msg.addAVP(tmp)
-
-        # productname
-        tmp = DiameterAVP()
-        tmp.setCode(269)
-        tmp.setMandatory(True)
-        tmp.setOctetString(self.stack.product_name)
-        msg.addAVP(tmp)
-
-        # firmware
-        tmp = DiameterAVP()
-        tmp.setCode(267)
-        tmp.setMandatory(True)
-        tmp.setInteger32(self.stack.firmware_revision)
-        msg.addAVP(tmp)
-
-        # host ip
-        tmp = DiameterAVP()
-        tmp.setCode(257)
-        tmp.setMandatory(True)
-        tmp.setIPV4(self.stack.ip4_address)
-        msg.addAVP(tmp)
-
-        # get supported vendors from stack
-        for vendor in self.stack.supported_vendors:
-            supp = DiameterAVP()
-            supp.setCode(265)
-            supp.setMandatory(True)
-            supp.setInteger32(vendor)
-            msg.addAVP(supp)
-
-        # get applications from stack
-        for apps in [self.stack.auth_apps, self.stack.acct_apps]:
-            for app in apps:
-                # Build *-Application-Id AVP
-                app_id = DiameterAVP()
-                if apps == self.stack.auth_apps:
-                    # App is for authentication, so use Auth-Application-Id AVP code
-                    app_id.setCode(258)
-                    _log.debug("CER Auth-Application-Id %d", app[1])
-                else:
-                    # App is for accounting, so use Acct-Application-Id AVP code
-                    app_id.setCode(259)
-                    _log.debug("CER Acct-Application-Id %d", app[1])
-                app_id.setMandatory(True)
-                app_id.setInteger32(app[1])
-
-                if app[0]:
-                    tmp = DiameterAVP()
-                    tmp.setCode(260)
-                    tmp.setMandatory(True)
-                    # vendor
-                    v = DiameterAVP()
-                    v.setCode(266)
-                    v.setMandatory(True)
-                    v.setInteger32(app[0])
-                    tmp.addAVP(v)
-                    tmp.addAVP(app_id)
-                    msg.addAVP(tmp)
-                else:
-                    msg.addAVP(app_id)
+        msg = self.stack.createRequest(0, 257, peer=self.peer)
+        for avp in self.stack.capabilitiesAVPs():
+            msg.addAVP(avp)
 
         _log.debug("Send CEA")
         self.stack.sendByPeer(self.peer, msg, False)
@@ -171,6 +111,8 @@ class PeerStateMachine:
                 _log.debug("Received Device-Watchdog-Request message from peer %s, replying", self.peer)
                 answ = self.stack.createAnswer(message, 2001)
                 self.stack.sendByPeer(self.peer, answ, False)
+            else:
+                self.peer.watchdogAnswered()
             return
 
         self.stack.handleIncomingMessage(self.peer, message)
@@ -196,6 +138,11 @@ class PeerStateMachine:
         apps = dict()
 
         reply = self.stack.createAnswer(message, 2001)
+        # same capabilities as our CER, Host-IP-Address included, with
+        # only the applications both sides support
+        for avp in self.stack.capabilitiesAVPs():
+            if avp.avp_code not in (258, 259, 260):
+                reply.addAVP(avp)
 
         for appId in message.findAVP(258):
             if (0, appId.getInteger32()) in self.stack.auth_apps:
@@ -215,19 +162,82 @@ class PeerStateMachine:
                        identity, realm, apps)
 
 
+class ReceiveBuffer:
+    """Per-peer receive buffer.
+
+    Incoming data is appended to a single bytearray and messages are framed
+    by offset. The consumed prefix is only dropped once it is both larger
+    than COMPACT_SIZE and larger than the pending data, so compaction cost
+    stays linear in the amount of data received."""
+    COMPACT_SIZE = 65536
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.data) - self.offset
+
+    def append(self, data):
+        self.data += data
+
+    def consume(self, length):
+        self.offset += length
+        pending = len(self.data) - self.offset
+        if pending == 0:
+            del self.data[:]
+            self.offset = 0
+        elif self.offset >= self.COMPACT_SIZE and self.offset >= pending:
+            del self.data[:self.offset]
+            self.offset = 0
+
+
+class SendQueue:
+    """Messages waiting to be written to a peer.
+
+    They are encoded together into one buffer and written at once when
+    the transport flushes the queue, at the end of the loop iteration."""
+    def __init__(self):
+        self.messages = list()
+        self.size = 0
+        # a flush is on its way
+        self.scheduled = False
+        # the transport asked us to stop writing
+        self.blocked = False
+
+
 class Peer:
+    # RFC 3539 watchdog states, only OKAY peers get new requests
+    WATCHDOG_OKAY = 0
+    WATCHDOG_SUSPECT = 1
+    WATCHDOG_DOWN = 2
+
     def __init__(self, manager, peer_type):
         self.applications = None
         self.manager = manager
         self.stack = manager.stack
         self.identity = None
         self.realm = None
+        # when the last DWR was sent and the watchdog timer
         self.last_watchdog = None
         self.next_tick = None
+        self.last_activity = 0
+        self.watchdog_state = Peer.WATCHDOG_OKAY
+        self.watchdog_pending = False
+        # requests waiting for an answer and share of the load, see routing
+        self.outstanding = 0
+        self.weight = 1
         self.state = None
         self.ipv4 = None
         self.port = None
         self.peer_type = peer_type
+        self.hop_by_hop = self.stack.newHopByHopIds()
+        self.rx_buffer = ReceiveBuffer()
+        # bytes feed handed to the state machine so far, see receive
+        self.fed = 0
+        self.tx_queue = SendQueue()
+        # applications were told to hold off sending to this peer
+        self.paused = False
         self.fsm = PeerStateMachine(self, peer_type)
         pass
 
@@ -238,8 +248,11 @@ class Peer:
                " ipv4=%s>" \
                % (self.identity, self.realm, self.ipv4)
 
-    def feed(self, buf, length):
-        """Returns the amount of bytes consumed from buf"""
+    def feed(self, buf, length, offset=0):
+        """Returns the amount of bytes consumed from buf
+
+        Messages are framed in place starting at offset, buf is never
+        re-sliced between messages."""
         total_consumed = 0
 
         # special signal, send it up the stack
@@ -252,15 +265,23 @@ class Peer:
             self.fsm.run(-1, None)
             return -1
 
+        # any traffic counts as a watchdog answer
+        self.last_activity = self.stack.timers.clock()
+        if self.watchdog_state == Peer.WATCHDOG_SUSPECT:
+            self.watchdogFailback()
+
         # while we have an entire diameter header
         while length >= 20:
-            version_length = struct.unpack("!i", buf[:4])[0]
+            version_length = UINT32.unpack_from(buf, offset)[0]
             version = version_length >> 24
             msg_length = (version_length & 0x00ffffff)
 
             # protocol error, disconnect
             if version != 1:
                 pass
+            if msg_length < 20:
+                _log.error("Peer %s sent a message of length %d", self, msg_length)
+                return -1
 
             # can't read one entire message
             # caller should buffer
@@ -268,22 +289,108 @@ class Peer:
                 return total_consumed
 
             msg = DiameterMessage()
-            consumed = msg.parseFromBuffer(buf)
+            metrics = self.stack.metrics
+            try:
+                if metrics is None:
+                    consumed = msg.parseFromBuffer(buf, offset, self.stack.lazy_decode)
+                else:
+                    started = now()
+                    consumed = msg.parseFromBuffer(buf, offset, self.stack.lazy_decode)
+                    metrics.received(self, consumed, now() - started)
+            except (ValueError, struct.error):
+                _log.exception("Peer %s sent a malformed message", self)
+                return -1
+            if consumed > 0:
+                # handed over, never again even if the handler raises
+                self.fed += consumed
             self.fsm.run(consumed, msg)
 
             # protocol error, disconnect
             if consumed <= 0:
                 return consumed
 
-            # remove the handled message ready to go round again
-            buf = buf[consumed:]
+            # step over the handled message ready to go round again
+            offset += consumed
             length -= consumed
             total_consumed += consumed
 
         return total_consumed
 
+    def receive(self, data):
+        """Buffer data read from the transport and feed every complete
+        message to the state machine. Returns what feed returned."""
+        rx = self.rx_buffer
+        rx.append(data)
+        self.fed = 0
+        try:
+            return self.feed(rx.data, len(rx), rx.offset)
+        finally:
+            # what was handed to the state machine, also when it raised
+            if self.fed > 0:
+                rx.consume(self.fed)
+
+    def isAvailable(self):
+        return self.watchdog_state == Peer.WATCHDOG_OKAY and not self.paused
+
+    def watchdogInterval(self):
+        """Tw with the +/- 2 seconds jitter of RFC 3539"""
+        return max(self.stack.watchdog_seconds + random.uniform(-2, 2), 6)
+
+    def startWatchdog(self):
+        if not self.stack.watchdog_seconds:
+            return
+        self.stopWatchdog()
+        self.watchdog_state = Peer.WATCHDOG_OKAY
+        self.watchdog_pending = False
+        self.last_activity = self.stack.timers.clock()
+        self.next_tick = self.stack.timers.schedule(self.watchdogInterval(), self.watchdogExpired)
+
+    def stopWatchdog(self):
+        if self.next_tick is not None:
+            self.next_tick.cancel()
+            self.next_tick = None
+
+    def watchdogExpired(self):
+        """Tw expired, send a DWR or degrade the peer.
+
+        Received traffic only updates last_activity, the timer is pushed
+        back here instead of being re-armed for every message."""
+        timers = self.stack.timers
+        now = timers.clock()
+        interval = self.watchdogInterval()
+
+        if self.last_activity + interval > now:
+            self.next_tick = timers.scheduleAt(self.last_activity + interval, self.watchdogExpired)
+            return
+
+        if not self.watchdog_pending:
+            _log.debug("Sending Device-Watchdog-Request to peer %s", self)
+            self.watchdog_pending = True
+            self.last_watchdog = now
+            self.stack.sendByPeer(self, self.stack.createWatchdogRequest(self), False)
+        elif self.watchdog_state == Peer.WATCHDOG_OKAY:
+            _log.warning("No Device-Watchdog-Answer from peer %s, suspect", self)
+            self.watchdog_state = Peer.WATCHDOG_SUSPECT
+        else:
+            _log.error("No answer from suspect peer %s, down", self)
+            self.next_tick = None
+            self.watchdog_state = Peer.WATCHDOG_DOWN
+            self.stack.peerDown(self)
+            return
+
+        self.next_tick = timers.schedule(interval, self.watchdogExpired)
+
+    def watchdogAnswered(self):
+        self.watchdog_pending = False
+        if self.watchdog_state == Peer.WATCHDOG_SUSPECT:
+            self.watchdogFailback()
+
+    def watchdogFailback(self):
+        _log.info("Peer %s is back", self)
+        self.watchdog_state = Peer.WATCHDOG_OKAY
+
     def destroy(self):
-        pass
+        self.stopWatchdog()
 
 
 class Realm:
@@ -308,9 +415,9 @@ class Realm:
             if self.applications.has_key(app):
                 appentry = self.applications[app]
             else:
-                appentry = list()
+                appentry = PeerList()
                 self.applications[app] = appentry
-            appentry.append(peer)
+            appentry.add(peer)
 
         _log.debug("Added identity %s to realm %s as peer %s",
                    identity,
@@ -319,14 +426,15 @@ class Realm:
         return True
 
     def removePeer(self, peer):
-        self.identities.pop(peer.identity, None)
+        """False if peer wasn't in the realm"""
+        if self.identities.get(peer.identity) is not peer:
+            return False
+        del self.identities[peer.identity]
         for app in self.applications.values():
-            try:
-                app.remove(peer)
-            except ValueError:
-                pass
+            app.discard(peer)
         _log.debug("Remover identity %s to realm %s as peer %s",
                    peer.identity, self.name, peer)
+        return True
 
 
 
@@ -344,6 +452,24 @@ class PeerIOCallbacks:
     def close(self, peer):
         pass
 
+    def callSoon(self, callback, *args):
+        """Run callback(*args) on the I/O thread, safe from any thread.
+        Transports running on a thread of their own set Stack.io_thread
+        and override this, ThreadDispatcher and ProcessDispatcher need
+        both."""
+        callback(*args)
+
+    def flushLater(self, peer):
+        """Write what is queued for peer once the current burst is over.
+        Transports with an event loop defer it to the end of the loop
+        iteration, this one writes right away."""
+        peer.manager.flush(peer)
+
+    def abort(self, peer):
+        """Drop the connection of a peer the watchdog gave up on,
+        clients may reconnect"""
+        self.close(peer)
+
     def write(self, peer, data, length):
         pass
 
@@ -354,6 +480,9 @@ class PeerManager:
         self.realms = dict()
         self.peers = list()
         self.io_cb = PeerIOCallbacks()
+        # (realm, app) -> RoutingStrategy, default_strategy for the others
+        self.strategies = dict()
+        self.default_strategy = LeastOutstanding()
 
     def clientV4Add(self, host, port):
         peer = Peer(self, PeerStateMachine.PEER_CLIENT)
@@ -371,8 +500,78 @@ class PeerManager:
         self.io_cb = pio
 
     def send(self, peer, message):
-        wire = message.getWire()
-        self.io_cb.write(peer, wire, len(wire))
+        """Queue message for peer, False if it was dropped because too
+        much is already waiting for it"""
+        queue = peer.tx_queue
+        if queue.size + message.message_length > self.stack.send_limit:
+            _log.error("Send queue of peer %s is full, dropping message %d", peer, message.hBh)
+            return False
+        queue.messages.append(message)
+        queue.size += message.message_length
+        if not queue.blocked and not queue.scheduled:
+            queue.scheduled = True
+            self.io_cb.flushLater(peer)
+        if not peer.paused:
+            self.checkPressure(peer)
+        return True
+
+    def unqueue(self, peer, message):
+        """Take message back out of the send queue of peer, False if it
+        isn't waiting there"""
+        queue = peer.tx_queue
+        if message not in queue.messages:
+            return False
+        queue.messages.remove(message)
+        queue.size -= message.message_length
+        return True
+
+    def flush(self, peer):
+        """Encode everything queued for peer into one buffer and write it"""
+        queue = peer.tx_queue
+        queue.scheduled = False
+        if queue.blocked or not queue.messages:
+            return
+        messages = queue.messages
+        queue.messages = list()
+        queue.size = 0
+        # not queue.size, a message may have changed since it was queued
+        size = sum(message.updateLength() for message in messages)
+
+        metrics = self.stack.metrics
+        if metrics is not None:
+            started = now()
+        buf = bytearray(size)
+        offset = 0
+        for message in messages:
+            message.markSent()
+            offset = message.encodeInto(buf, offset)
+        if metrics is not None:
+            metrics.sent(peer, len(messages), size, now() - started)
+        self.io_cb.write(peer, bytes(buf), size)
+        self.checkPressure(peer)
+
+    def pauseWriting(self, peer):
+        """The transport can't take more for now, queue until resumed"""
+        peer.tx_queue.blocked = True
+        self.checkPressure(peer)
+
+    def resumeWriting(self, peer):
+        peer.tx_queue.blocked = False
+        self.flush(peer)
+        self.checkPressure(peer)
+
+    def checkPressure(self, peer):
+        """Pause applications while the transport is blocked or high
+        watermark bytes are queued, resume them once it is writing again
+        and the queue is down to the low watermark"""
+        queue = peer.tx_queue
+        if not peer.paused:
+            if queue.blocked or queue.size >= self.stack.send_high_watermark:
+                peer.paused = True
+                self.stack.peerPaused(peer)
+        elif not queue.blocked and queue.size <= self.stack.send_low_watermark:
+            peer.paused = False
+            self.stack.peerResumed(peer)
 
     def registerPeer(self, peer, identity, realm, apps):
         peer.identity = identity
@@ -389,4 +588,32 @@ class PeerManager:
 
     def removerPeer(self, peer):
         if peer.realm in self.realms:
-            self.realms[peer.realm].removePeer(peer)
\ No newline at end of file
+            return self.realms[peer.realm].removePeer(peer)
+        return False
+
+    def setStrategy(self, strategy, realm=None, app=None):
+        """Route requests of app in realm with strategy, every request
+        without a strategy of its own if realm is None"""
+        if realm is None:
+            self.default_strategy = strategy
+        else:
+            self.strategies[(realm, app)] = strategy
+
+    def setWeight(self, peer, weight):
+        peer.weight = weight
+        prealm = self.realms.get(peer.realm)
+        if prealm is not None:
+            for peers in prealm.applications.values():
+                peers.state.clear()
+
+    def selectPeer(self, realm, app, message=None):
+        """Available peer of realm supporting app, a (vendor id,
+        application id) pair, or None"""
+        prealm = self.realms.get(realm)
+        if prealm is None:
+            return None
+        peers = prealm.applications.get(app)
+        if not peers:
+            return None
+        strategy = self.strategies.get((realm, app), self.default_strategy)
+        return strategy.select(peers, message)
@@ -2,20 +2,52 @@ from dictionary import DiameterDictionary
 import sys, warnings
 import socket
 import struct
-import time
+from array import array
+from diameter.codec import MESSAGE_HEADER, AVP_HEADER, AVP_HEADER_VENDOR, \
+    UINT32, INT32, UINT64, INT64, FLOAT32, FLOAT64, ADDRESS_FAMILY, DEFAULT_CODEC
+from diameter.resolver import resolver
+from diameter.timer import now
 
+# IANA address family numbers of the Address AVP type
+ADDRESS_FAMILIES = {socket.AF_INET: 1, socket.AF_INET6: 2}
 
-class DiameterAVP:
-    def __init__(self):
+# zero padding, indexed by the number of bytes needed
+PADDING = ("", "\0", "\0\0", "\0\0\0")
+
+
+# groups smaller than this are scanned instead of indexed
+INDEX_MIN_AVPS = 8
+
+
+def indexAVPs(avps):
+    """Map (code, vendor) to the positions of the matching avps"""
+    index = {}
+    for n, avp in enumerate(avps):
+        key = (avp.avp_code, avp.avp_vendor)
+        if key in index:
+            index[key].append(n)
+        else:
+            index[key] = [n]
+    return index
+
+
+class DiameterAVP(object):
+    __slots__ = ('type_size', 'avp_size', 'avp_code', 'avp_vendor', 'avp_data',
+                 'avp_group', 'avp_index', 'mandatory_flag', 'protected_flag', 'codec')
+
+    def __init__(self, code=0, vendor=0, mandatory=False, protected=False, codec=DEFAULT_CODEC):
         self.type_size = 0
-        self.avp_size = 8
-        self.avp_code = 0
-        self.avp_vendor = 0
+        self.avp_size = vendor > 0 and 12 or 8
+        self.avp_code = code
+        self.avp_vendor = vendor
         self.avp_data = ""
-        self.avp_group = []
-        self.__groupOpen = False
-        self.mandatory_flag = False
-        self.protected_flag = False
+        # children, None until the group is opened by getGroup/addAVP
+        self.avp_group = None
+        self.avp_index = None
+        self.mandatory_flag = mandatory
+        self.protected_flag = protected
+        # typed codec bound from the dictionary, see getValue/setValue
+        self.codec = codec
 
     def __str__(self):
         mflag = self.mandatory_flag and "M" or "."
@@ -42,28 +74,80 @@ class DiameterAVP:
 
     def setInteger32(self, i):
         self.type_size = 4
-        self.avp_data = struct.pack("!I", i)
+        self.avp_data = UINT32.pack(i)
 
     def withInteger32(self, i):
         self.setInteger32(i)
         return self
 
     def getInteger32(self):
-        i = struct.unpack("!I", self.avp_data)[0]
+        i = UINT32.unpack(self.avp_data)[0]
         return i
 
     def setInteger64(self, i):
         self.type_size = 8
-        self.avp_data = struct.pack("!Q", i)
+        self.avp_data = UINT64.pack(i)
 
     def withInteger64(self, i):
         self.setInteger64(i)
         return self
 
     def getInteger64(self):
-        i = struct.unpack("!Q", self.avp_data)[0]
+        i = UINT64.unpack(self.avp_data)[0]
         return i
 
+    # Unsigned32/64 are what setInteger32/64 always encoded
+    setUnsigned32 = setInteger32
+    withUnsigned32 = withInteger32
+    getUnsigned32 = getInteger32
+    setUnsigned64 = setInteger64
+    withUnsigned64 = withInteger64
+    getUnsigned64 = getInteger64
+
+    def setSigned32(self, i):
+        self.type_size = 4
+        self.avp_data = INT32.pack(i)
+
+    def withSigned32(self, i):
+        self.setSigned32(i)
+        return self
+
+    def getSigned32(self):
+        return INT32.unpack(self.avp_data)[0]
+
+    def setSigned64(self, i):
+        self.type_size = 8
+        self.avp_data = INT64.pack(i)
+
+    def withSigned64(self, i):
+        self.setSigned64(i)
+        return self
+
+    def getSigned64(self):
+        return INT64.unpack(self.avp_data)[0]
+
+    def setFloat32(self, f):
+        self.type_size = 4
+        self.avp_data = FLOAT32.pack(f)
+
+    def withFloat32(self, f):
+        self.setFloat32(f)
+        return self
+
+    def getFloat32(self):
+        return FLOAT32.unpack(self.avp_data)[0]
+
+    def setFloat64(self, f):
+        self.type_size = 8
+        self.avp_data = FLOAT64.pack(f)
+
+    def withFloat64(self, f):
+        self.setFloat64(f)
+        return self
+
+    def getFloat64(self):
+        return FLOAT64.unpack(self.avp_data)[0]
+
     def setOctetString(self, str):
         self.type_size = len(str)
         self.avp_data = str
@@ -75,26 +159,63 @@ class DiameterAVP:
     def getOctetString(self):
         return self.avp_data
 
+    def getValue(self):
+        """Decode the data with the codec of the avp's dictionary type"""
+        return self.codec.decode(self)
+
+    def setValue(self, value):
+        self.codec.encode(self, value)
+
+    def withValue(self, value):
+        self.setValue(value)
+        return self
+
+    def getAddress(self):
+        """IPv4/IPv6 address as text, other families as raw octets"""
+        family = ADDRESS_FAMILY.unpack_from(self.avp_data)[0]
+        if family == 1:
+            return socket.inet_ntop(socket.AF_INET, self.avp_data[2:])
+        if family == 2:
+            return socket.inet_ntop(socket.AF_INET6, self.avp_data[2:])
+        return self.avp_data[2:]
+
+    def setAddress(self, addr):
+        """Set from an IPv4/IPv6 literal or a host name. Names go through
+        the caching resolver, the first address (IPv4 first) is used. On
+        the I/O thread a name must have been prefetched, socket.error is
+        raised otherwise, see Resolver.lookup."""
+        addresses = resolver.lookup(addr)
+        if not addresses:
+            raise socket.error("Could not resolve %s" % addr)
+        family, packed = addresses[0]
+        self.avp_data = ADDRESS_FAMILY.pack(ADDRESS_FAMILIES[family]) + packed
+        self.type_size = len(self.avp_data)
+
+    def withAddress(self, addr):
+        self.setAddress(addr)
+        return self
+
+    # kept for existing callers, both handle IPv6 too
     def getIPV4(self):
-        return socket.inet_ntop(socket.AF_INET, self.avp_data[2:])
+        return self.getAddress()
 
     def setIPV4(self, addr):
-        address = socket.getaddrinfo(addr, 0)
-        for a in address:
-            if a[0] == socket.AF_INET:
-                raw = socket.inet_pton(socket.AF_INET, a[4][0]);
-                self.avp_data = struct.pack("!h4s", 1, raw)
-                # 2 = socket type, 4 = octects for ip
-                self.type_size = 6
+        self.setAddress(addr)
 
     def withIPV4(self, addr):
         self.setIPV4(addr)
         return self
 
     def addAVP(self, avp):
-        self.avp_group.append(avp)
+        group = self.getGroup()
+        group.append(avp)
+        if self.avp_index is not None:
+            self.avp_index.setdefault((avp.avp_code, avp.avp_vendor), []).append(len(group) - 1)
+        elif len(group) >= INDEX_MIN_AVPS:
+            self.avp_index = indexAVPs(group)
         self.type_size += avp.getPaddedSize()
-        self.avp_data += avp.getWire()
+        # children are encoded straight from avp_group from now on
+        self.avp_data = ""
 
     def withAVP(self, avp):
         self.addAVP(avp)
@@ -108,28 +229,37 @@ class DiameterAVP:
             return None
 
     def findAVP(self, code, vendor=0):
-        retList = []
-
-        if self.__groupOpen == False:
+        if self.avp_group is None:
             self.getGroup()
 
-        for avp in self.avp_group:
-            if avp.avp_code == code and avp.avp_vendor == vendor:
-                retList.append(avp)
-        return retList
+        if self.avp_index is None:
+            return [avp for avp in self.avp_group
+                    if avp.avp_code == code and avp.avp_vendor == vendor]
+
+        positions = self.avp_index.get((code, vendor))
+        if not positions:
+            return []
+        return [self.avp_group[n] for n in positions]
 
     def getGroup(self):
-        if self.__groupOpen:
+        if self.avp_group is not None:
             return self.avp_group
+        group = []
         i = 0
         while i < self.type_size:
             avp = DiameterAVP()
             i += avp.parseFromBuffer(self.avp_data, i)
-            self.avp_group.append(avp)
-        self.__groupOpen = True
-        return self.avp_group
+            group.append(avp)
+        if len(group) >= INDEX_MIN_AVPS:
+            self.avp_index = indexAVPs(group)
+        self.avp_group = group
+        return group
 
     def getFinalSize(self):
+        if self.avp_group is not None:
+            # open group, sized from its children as they are now, any of
+            # them may have been changed since it was added
+            self.type_size = sum(avp.getPaddedSize() for avp in self.avp_group)
         return self.avp_size + self.type_size
 
     def getPaddedSize(self):
@@ -137,47 +267,73 @@ class DiameterAVP:
         return length
 
     def getWire(self):
-        buffers = [r'', r'', r'', r'']
-        flags = 0
+        buf = bytearray(self.getPaddedSize())
+        self.encodeInto(buf, 0)
+        return bytes(buf)
 
-        if self.avp_vendor > 0:
-            flags |= 0x80
-            buffers[1] = struct.pack("!I", self.avp_vendor)
+    def encodeInto(self, buf, offset):
+        """Write the avp, padding included, at offset in buf.
+        Returns the offset right after it."""
+        flags = 0
         if self.mandatory_flag:
             flags |= 0x40
         if self.protected_flag:
             flags |= 0x20
 
-        fl = (flags << 24) | (self.getFinalSize())
-
-        buffers[0] = struct.pack("!II", self.avp_code, fl)
-        buffers[2] = self.avp_data
+        length = self.getFinalSize()
+        end = offset + ((length + 3) & ~3)
+        if end > len(buf):
+            raise ValueError("%s does not fit at offset %d of %d bytes" % (self, offset, len(buf)))
+        # one pack_into beats copying a pre-packed header template and
+        # patching the length in, see benchmarks/bench_header.py
+        if self.avp_vendor > 0:
+            AVP_HEADER_VENDOR.pack_into(buf, offset, self.avp_code,
+                                        ((flags | 0x80) << 24) | length, self.avp_vendor)
+        else:
+            AVP_HEADER.pack_into(buf, offset, self.avp_code, (flags << 24) | length)
 
-        # put padding in place
-        length = self.getPaddedSize() - self.getFinalSize()
-        for i in range(length, 0, -1):
-            buffers[3] += struct.pack("b", 0)
+        i = offset + self.avp_size
+        # open group, encode the children in place
+        if self.avp_group is not None:
+            for avp in self.avp_group:
+                i = avp.encodeInto(buf, i)
+        else:
+            i += len(self.avp_data)
+            buf[offset + self.avp_size:i] = self.avp_data
+        if i != offset + length:
+            raise ValueError("%s encoded %d bytes instead of %d" % (self, i - offset, length))
 
-        retVal = r''.join(buffers)
-        return retVal
+        pad = -length & 3
+        if pad:
+            buf[i:i + pad] = PADDING[pad]
+        return end
 
     def parseFromBuffer(self, inBuf, index):
-        cc, fl = struct.unpack("!II", inBuf[index:index + 8])
+        # code, flags+length and vendor in one call, the third word is
+        # only the vendor when the V flag is set
+        try:
+            cc, fl, vendor = AVP_HEADER_VENDOR.unpack_from(inBuf, index)
+        except struct.error:
+            # header only avp at the very end of the buffer
+            cc, fl = AVP_HEADER.unpack_from(inBuf, index)
         self.avp_code = cc
         flags = fl >> 24
         length = fl & 0x00ffffff
+        # malformed, a zero length would never step over the avp
+        if length < (12 if flags & 0x80 else 8) or index + length > len(inBuf):
+            raise ValueError("AVP %d at offset %d has invalid length %d" % (cc, index, length))
         # skip header (length)
         self.type_size = length - 8
         if flags & 0x80:
             self.avp_size = 12
-            self.avp_vendor = struct.unpack("!I", inBuf[index + 8:index + 12])[0]
+            self.avp_vendor = vendor
             self.type_size -= 4
             self.avp_data = inBuf[index + 12:index + 12 + self.type_size]
         else:
             self.avp_data = inBuf[index + 8:index + 8 + self.type_size]
             self.avp_size = 8
 
-        if flags & 0x60:
+        if flags & 0x40:
             self.mandatory_flag = True
         if flags & 0x20:
             self.protected_flag = True
@@ -186,7 +342,48 @@ class DiameterAVP:
         return retLength
 
 
-class DiameterMessage:
+class FrozenAVP(DiameterAVP):
+    """An AVP encoded once, its wire bytes are copied as they are into
+    every message it is added to. Shared between messages, so every
+    setter raises TypeError, copy() gives a DiameterAVP to change."""
+    __slots__ = ('wire',)
+
+    def __init__(self, avp):
+        for name in DiameterAVP.__slots__:
+            setattr(self, name, getattr(avp, name))
+        if avp.avp_group is not None:
+            self.avp_group = tuple(FrozenAVP(child) for child in avp.avp_group)
+        self.wire = avp.getWire()
+
+    def copy(self):
+        avp = DiameterAVP(codec=self.codec)
+        avp.parseFromBuffer(self.wire, 0)
+        return avp
+
+    def getWire(self):
+        return self.wire
+
+    def encodeInto(self, buf, offset):
+        end = offset + len(self.wire)
+        buf[offset:end] = self.wire
+        return end
+
+    def frozen(self, *args):
+        raise TypeError("%s is shared between messages, change a copy() of it" % self)
+
+
+for name in dir(DiameterAVP):
+    if name.startswith('set') or name == 'addAVP':
+        setattr(FrozenAVP, name, FrozenAVP.__dict__['frozen'])
+del name
+
+
+class DiameterMessage(object):
+    __slots__ = ('eTe', 'hBh', 'application_id', 'command_code', 'version',
+                 'request_flag', 'proxiable_flag', 'error_flag', 'retransmit_flag',
+                 'message_length', '_avp_group', '_raw', '_avp_table', '_avp_index',
+                 'retries', 'last_try', 'session', 'hbh_peer')
+
     def __init__(self):
         self.eTe = 0
         self.hBh = 0
@@ -199,35 +396,109 @@ class DiameterMessage:
         self.retransmit_flag = False
         # minimum header size
         self.message_length = 20
-        self.avp_group = []
+        self._avp_group = []
+        # lazy mode: raw message and the offset table of its root avps
+        self._raw = None
+        self._avp_table = None
+        # (code, vendor) -> positions, built at parse time or on first lookup
+        self._avp_index = None
 
         self.retries = 0
+        # monotonic time of the last send
         self.last_try = 0
+        # set by the stack when it keeps sessions, see diameter.session
+        self.session = None
+        # peer whose hop-by-hop ids numbered this request, see Stack.numberRequest
+        self.hbh_peer = None
+
+    @property
+    def avp_group(self):
+        return self.getGroup()
 
     def getGroup(self):
-        return self.avp_group
+        if self._avp_table is not None:
+            for n in range(len(self._avp_group)):
+                if self._avp_group[n] is None:
+                    self._materialize(n)
+            self._raw = None
+            self._avp_table = None
+        return self._avp_group
+
+    def _materialize(self, n):
+        avp = DiameterAVP()
+        avp.parseFromBuffer(self._raw, self._avp_table[n * 5 + 3])
+        self._avp_group[n] = avp
+        return avp
 
     def findFirstAVP(self, code, vendor=0):
-        r = self.findAVP(code, vendor)
-        if len(r) > 0:
-            return r[0]
-        else:
+        index = self._avp_index
+        if index is None:
+            index = self._avp_index = indexAVPs(self._avp_group)
+
+        positions = index.get((code, vendor))
+        if not positions:
             return None
+        n = positions[0]
+        return self._avp_group[n] or self._materialize(n)
 
     def findAVP(self, code, vendor=0):
-        retList = []
-
-        for avp in self.avp_group:
-            if avp.avp_code == code and avp.avp_vendor == vendor:
-                retList.append(avp)
-        return retList
-
-    def getWire(self):
+        index = self._avp_index
+        if index is None:
+            index = self._avp_index = indexAVPs(self._avp_group)
+
+        positions = index.get((code, vendor))
+        if not positions:
+            return []
+        group = self._avp_group
+        return [group[n] or self._materialize(n) for n in positions]
+
+    def markSent(self):
+        """Count one more send, every one after the first is flagged as
+        a retransmission"""
         if self.retries > 0:
             self.retransmit_flag = True
         self.retries += 1
-        self.last_retry = int(time.time())
+        self.last_try = now()
+
+    def getWire(self):
+        self.markSent()
+        buf = bytearray(self.updateLength())
+        self.encodeInto(buf, 0)
+        return bytes(buf)
+
+    def getBytes(self):
+        """Wire form of the message without counting a send. The bytes a
+        lazily parsed message was received as are reused while none of
+        its AVPs was materialized, just the header is written again. Any
+        AVP handed out may have been changed in place, so the message is
+        encoded again from its AVPs otherwise."""
+        if self._raw is not None and not any(self._avp_group):
+            buf = bytearray(self._raw)
+            self.encodeHeader(buf, 0)
+            return bytes(buf)
+        buf = bytearray(self.updateLength())
+        self.encodeInto(buf, 0)
+        return bytes(buf)
+
+    def updateLength(self):
+        """Size message_length from the AVPs as they are now, any of them
+        may have been resized since it was added. Returns it."""
+        if self._raw is None or any(self._avp_group):
+            self.message_length = 20 + sum(avp.getPaddedSize() for avp in self.getGroup())
+        return self.message_length
 
+    def encodeInto(self, buf, offset):
+        """Write the whole message at offset in buf, which must have
+        message_length bytes available. Returns the offset after it."""
+        self.encodeHeader(buf, offset)
+        i = offset + 20
+        for avp in self.avp_group:
+            i = avp.encodeInto(buf, i)
+        if i != offset + self.message_length:
+            raise ValueError("AVPs end at %d in a message of length %d" % (i - offset, self.message_length))
+        return i
+
+    def encodeHeader(self, buf, offset):
         v_ml = (self.version << 24) | self.message_length
         flags = 0
         if self.request_flag:
@@ -239,20 +510,19 @@ class DiameterMessage:
         if self.retransmit_flag:
             flags |= 0x10
         f_code = (flags << 24) | self.command_code
-        buffers = [r'']
-        buffers[0] = struct.pack("!IIIII", v_ml, f_code, self.application_id, self.hBh, self.eTe)
-        for avp in self.avp_group:
-            buffers.append(avp.getWire())
+        MESSAGE_HEADER.pack_into(buf, offset, v_ml, f_code, self.application_id, self.hBh, self.eTe)
+
+    def parseFromBuffer(self, inBuf, offset=0, lazy=False):
+        """Parse the message starting at offset in inBuf.
 
-        retVal = r''.join(buffers)
-        return retVal
+        inBuf may be a str or a bytearray receive buffer; the message
+        region is copied out once and the AVPs are parsed from that copy,
+        so the caller is free to compact its buffer afterwards.
 
-    def parseFromBuffer(self, inBuf):
-        v_ml = struct.unpack("!I", inBuf[0:4])[0]
-        f_code = struct.unpack("!I", inBuf[4:8])[0]
-        appId = struct.unpack("!I", inBuf[8:12])[0]
-        hbh = struct.unpack("!I", inBuf[12:16])[0]
-        ete = struct.unpack("!I", inBuf[16:20])[0]
+        In lazy mode only the root AVP headers are scanned into an offset
+        table of (code, vendor, flags, offset, length) entries, AVP objects
+        are created on first access through findAVP/findFirstAVP/getGroup."""
+        v_ml, f_code, appId, hbh, ete = MESSAGE_HEADER.unpack_from(inBuf, offset)
 
         self.version = v_ml >> 24;
         self.message_length = (v_ml & 0x00ffffff)
@@ -269,16 +539,57 @@ class DiameterMessage:
             self.error_flag = True
         if flags & 0x10:
             self.retransmit_flag = True
+
+        if offset or not isinstance(inBuf, bytes):
+            inBuf = memoryview(inBuf)[offset:offset + self.message_length].tobytes()
+        if lazy:
+            self._scanAVPs(inBuf)
+            return self.message_length
+
         # parse the root avps
         i = 20
         while i < self.message_length:
             avp = DiameterAVP()
             i += avp.parseFromBuffer(inBuf, i)
-            self.avp_group.append(avp)
+            self._avp_group.append(avp)
+        if i != self.message_length:
+            raise ValueError("AVPs end at %d in a message of length %d" % (i, self.message_length))
+        self._avp_index = indexAVPs(self._avp_group)
         return self.message_length
 
+    def _scanAVPs(self, inBuf):
+        table = array('I')
+        index = {}
+        i = 20
+        while i < self.message_length:
+            try:
+                cc, fl, vendor = AVP_HEADER_VENDOR.unpack_from(inBuf, i)
+            except struct.error:
+                cc, fl = AVP_HEADER.unpack_from(inBuf, i)
+            flags = fl >> 24
+            length = fl & 0x00ffffff
+            # malformed, avoid looping forever on a zero length
+            if length < (12 if flags & 0x80 else 8) or i + length > len(inBuf):
+                raise ValueError("AVP %d at offset %d has invalid length %d" % (cc, i, length))
+            if not flags & 0x80:
+                vendor = 0
+            key = (cc, vendor)
+            if key in index:
+                index[key].append(len(table) // 5)
+            else:
+                index[key] = [len(table) // 5]
+            table.extend((cc, vendor, flags, i, length))
+            i += (length + 3) & ~3
+        self._raw = inBuf
+        self._avp_table = table
+        self._avp_index = index
+        self._avp_group = [None] * (len(table) // 5)
+
     def addAVP(self, avp):
-        self.avp_group.append(avp)
+        group = self.getGroup()
+        if self._avp_index is not None:
+            self._avp_index.setdefault((avp.avp_code, avp.avp_vendor), []).append(len(group))
+        group.append(avp)
         self.message_length += avp.getPaddedSize()
 
     def __str__(self):
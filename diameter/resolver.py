@@ -0,0 +1,121 @@
+"""Host name resolution for Address AVPs
+
+Literal IPv4/IPv6 addresses never reach the resolver. Names are resolved
+with getaddrinfo and cached for ttl seconds; resolveAsync/prefetch run
+the lookup on a thread pool so an event loop never waits for DNS.
+lookup itself blocks on a miss, except on io_thread where it starts the
+lookup in the background and raises instead; the stack resolves its own
+addresses before connecting to a peer so its CER doesn't.
+"""
+import logging
+import socket
+import threading
+
+from diameter.timer import now
+
+_log = logging.getLogger("sdp.diameter.resolver")
+
+
+def parseLiteral(addr):
+    """(family, packed address) for an IPv4/IPv6 literal, None otherwise"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return family, socket.inet_pton(family, addr)
+        except (socket.error, ValueError):
+            pass
+    return None
+
+
+class Resolver:
+    def __init__(self, ttl=300, negative_ttl=30, max_entries=1024, workers=2, clock=now):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.workers = workers
+        self.clock = clock
+        # host -> (expires, [(family, packed address)])
+        self.cache = dict()
+        self.pool = None
+        self.lock = threading.Lock()
+        # event loop thread lookup must never block, set by transports
+        self.io_thread = None
+
+    def afterFork(self):
+        """Forget the pool threads of the parent in a forked child"""
+        self.pool = None
+        self.lock = threading.Lock()
+        self.io_thread = None
+
+    def cached(self, host):
+        """Cached addresses of host, None when unknown or expired"""
+        entry = self.cache.get(host)
+        if entry is not None and entry[0] > self.clock():
+            return entry[1]
+        return None
+
+    def isKnown(self, host):
+        """True when lookup(host) won't wait for DNS"""
+        return parseLiteral(host) is not None or self.cached(host) is not None
+
+    def lookup(self, host):
+        """Addresses of host, IPv4 first. Blocks on a cache miss, on
+        io_thread socket.error is raised then and host is prefetched,
+        see Stack.clientV4Add for how the stack avoids that."""
+        literal = parseLiteral(host)
+        if literal is not None:
+            return [literal]
+        addresses = self.cached(host)
+        if addresses is None:
+            if self.io_thread is not None and threading.current_thread() is self.io_thread:
+                self.prefetch(host)
+                raise socket.error("%s is being resolved, prefetch it before using it on the I/O thread" % host)
+            addresses = self.resolve(host)
+        return addresses
+
+    def resolve(self, host):
+        try:
+            info = socket.getaddrinfo(host, 0, 0, socket.SOCK_STREAM)
+        except (socket.error, UnicodeError) as e:
+            _log.error("Could not resolve %s: %s", host, e)
+            self.store(host, [], self.negative_ttl)
+            return []
+        addresses = []
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for a in info:
+                if a[0] == family:
+                    # drop any IPv6 scope, the AVP has no room for it
+                    entry = (family, socket.inet_pton(family, a[4][0].split('%')[0]))
+                    if entry not in addresses:
+                        addresses.append(entry)
+        self.store(host, addresses, self.ttl)
+        return addresses
+
+    def store(self, host, addresses, ttl):
+        current = self.clock()
+        if len(self.cache) >= self.max_entries:
+            # drop expired entries, then the ones closest to expiring
+            live = sorted((e for e in self.cache.items() if e[1][0] > current), key=lambda e: e[1][0])
+            self.cache = dict(live[len(live) - self.max_entries // 2:])
+        self.cache[host] = (current + ttl, addresses)
+
+    def resolveAsync(self, host, callback=None):
+        """Resolve host on the thread pool and call callback(addresses)
+        from a pool thread. Cached and literal hosts call back at once."""
+        literal = parseLiteral(host)
+        addresses = literal is not None and [literal] or self.cached(host)
+        if addresses is not None:
+            if callback is not None:
+                callback(addresses)
+            return
+        with self.lock:
+            if self.pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.pool = ThreadPool(self.workers)
+        self.pool.apply_async(self.resolve, (host,), callback=callback)
+
+    def prefetch(self, host):
+        self.resolveAsync(host)
+
+
+# shared by the Address AVP setters
+resolver = Resolver()
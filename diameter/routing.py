@@ -0,0 +1,155 @@
+"""Peer selection for the requests of a realm/application.
+
+PeerManager keeps a PeerList per realm and application, a strategy picks
+one of its available peers for each request."""
+from diameter.codec import UINT32
+import bisect
+import hashlib
+import random
+import logging
+
+_log = logging.getLogger("sdp.diameter.routing")
+
+
+class PeerList(list):
+    """Peers of a realm supporting one application.
+
+    Strategies keep what they derive from the peers in state, it is
+    dropped whenever a peer is added, removed or reweighted."""
+    def __init__(self):
+        list.__init__(self)
+        self.state = dict()
+        self.cursor = 0
+
+    def add(self, peer):
+        self.append(peer)
+        self.state.clear()
+
+    def discard(self, peer):
+        try:
+            self.remove(peer)
+        except ValueError:
+            return False
+        self.state.clear()
+        return True
+
+
+def firstAvailable(peers, start=0):
+    count = len(peers)
+    for i in range(count):
+        peer = peers[(start + i) % count]
+        if peer.isAvailable():
+            return peer
+    return None
+
+
+def hashKey(value):
+    return UINT32.unpack_from(hashlib.md5(value).digest())[0]
+
+
+class RoutingStrategy(object):
+    def select(self, peers, message):
+        """Peer of peers to send message to, None if none is available"""
+        pass
+
+
+class RoundRobin(RoutingStrategy):
+    def select(self, peers, message):
+        count = len(peers)
+        for i in range(count):
+            index = (peers.cursor + i) % count
+            peer = peers[index]
+            if peer.isAvailable():
+                peers.cursor = (index + 1) % count
+                return peer
+        return None
+
+
+class LeastOutstanding(RoutingStrategy):
+    """The peer with fewer requests waiting for an answer out of two
+    taken at random, which spreads load almost as well as comparing
+    every peer"""
+    def select(self, peers, message):
+        count = len(peers)
+        if count < 2:
+            return firstAvailable(peers)
+        i = random.randrange(count)
+        j = random.randrange(count - 1)
+        if j >= i:
+            j += 1
+        a = peers[i]
+        b = peers[j]
+        if b.outstanding < a.outstanding:
+            a, b = b, a
+        if a.isAvailable():
+            return a
+        if b.isAvailable():
+            return b
+        return firstAvailable(peers, i)
+
+
+class Weighted(RoutingStrategy):
+    """Random pick in proportion to Peer.weight"""
+    TRIES = 3
+
+    def select(self, peers, message):
+        table = peers.state.get(self)
+        if table is None:
+            table = self.build(peers)
+            peers.state[self] = table
+        totals, total = table
+        if not total:
+            return firstAvailable(peers)
+        for attempt in range(self.TRIES):
+            peer = peers[bisect.bisect_right(totals, random.random() * total)]
+            if peer.isAvailable():
+                return peer
+        return firstAvailable(peers)
+
+    def build(self, peers):
+        totals = list()
+        total = 0
+        for peer in peers:
+            total += max(peer.weight, 0)
+            totals.append(total)
+        return totals, total
+
+
+class ConsistentHash(RoutingStrategy):
+    """Requests of one Session-Id stick to one peer.
+
+    Each peer owns replicas points of a hash ring, adding or removing a
+    peer only moves the sessions next to its points. Requests without a
+    Session-Id go to fallback."""
+    def __init__(self, replicas=64, fallback=None):
+        self.replicas = replicas
+        if fallback is None:
+            fallback = LeastOutstanding()
+        self.fallback = fallback
+
+    def select(self, peers, message):
+        session = None
+        if message is not None:
+            session = message.findFirstAVP(263)
+        if session is None:
+            return self.fallback.select(peers, message)
+
+        ring = peers.state.get(self)
+        if ring is None:
+            ring = self.build(peers)
+            peers.state[self] = ring
+        points, owners = ring
+        if not points:
+            return None
+
+        # walk on to the next available peer if the owner isn't
+        start = bisect.bisect(points, hashKey(session.getOctetString()))
+        return firstAvailable(owners, start)
+
+    def build(self, peers):
+        ring = list()
+        for peer in peers:
+            for replica in range(self.replicas):
+                ring.append((hashKey("%s-%d" % (peer.identity, replica)), peer))
+        ring.sort(key=lambda point: point[0])
+        return [point[0] for point in ring], [point[1] for point in ring]
@@ -0,0 +1,120 @@
+"""Sessions keyed by Session-Id
+
+Stack.enableSessions creates a SessionTable, every message of a
+registered application then carries the Session object of its
+Session-Id in message.session. Applications keep their per-session state
+in session.data and call Stack.endSession once a session is over, idle
+ones are evicted by the stack timer and the least recently used go first
+when the table is full.
+"""
+from collections import OrderedDict
+import threading
+import logging
+
+from diameter.timer import now
+
+_log = logging.getLogger("sdp.diameter.session")
+
+
+class Session(object):
+    __slots__ = ('session_id', 'app', 'peer', 'last_seen', 'data')
+
+    def __init__(self, session_id, app=None, peer=None, last_seen=0):
+        self.session_id = session_id
+        # application and peer of the last message of the session
+        self.app = app
+        self.peer = peer
+        self.last_seen = last_seen
+        # whatever the application keeps for the session
+        self.data = None
+
+    def __repr__(self):
+        return "<diameter.session.Session %s>" % self.session_id
+
+
+class SessionTable:
+    """Sessions spread over shards, each one an OrderedDict from least
+    to most recently used behind its own lock, so dispatcher threads
+    rarely wait for each other.
+
+    expired(session) is called, without any lock held, for sessions
+    dropped because they were idle or the table was full."""
+    def __init__(self, idle_timeout=3600, max_sessions=1000000, shards=16,
+                 expired=None, clock=now):
+        self.idle_timeout = idle_timeout
+        self.shard_size = max(max_sessions // shards, 1)
+        self.shards = [OrderedDict() for i in range(shards)]
+        self.locks = [threading.Lock() for i in range(shards)]
+        self.expired = expired
+        self.clock = clock
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def shard(self, session_id):
+        return hash(session_id) % len(self.shards)
+
+    def get(self, session_id):
+        """Session of session_id, None if unknown. Doesn't count as use."""
+        return self.shards[self.shard(session_id)].get(session_id)
+
+    def touch(self, session_id, app=None, peer=None, create=True):
+        """Session of session_id, made the most recently used. Created
+        when unknown and create is set, None otherwise."""
+        n = self.shard(session_id)
+        shard = self.shards[n]
+        evicted = None
+        with self.locks[n]:
+            session = shard.pop(session_id, None)
+            if session is None:
+                if not create:
+                    return None
+                session = Session(session_id)
+                if len(shard) >= self.shard_size:
+                    evicted = shard.popitem(last=False)[1]
+            shard[session_id] = session
+            session.last_seen = self.clock()
+            if app is not None:
+                session.app = app
+                session.peer = peer
+
+        if evicted is not None:
+            _log.debug("Session table full, evicting %s", evicted.session_id)
+            if self.expired is not None:
+                self.expired(evicted)
+        return session
+
+    def lookup(self, message, app=None, peer=None):
+        """Session of message, a new one for a request with an unknown
+        Session-Id, None without Session-Id"""
+        avp = message.findFirstAVP(263)
+        if avp is None:
+            return None
+        return self.touch(avp.getOctetString(), app, peer, message.request_flag)
+
+    def remove(self, session_id):
+        n = self.shard(session_id)
+        with self.locks[n]:
+            return self.shards[n].pop(session_id, None)
+
+    def expire(self, current=None):
+        """Drop the sessions idle for idle_timeout, returns how many"""
+        if current is None:
+            current = self.clock()
+        deadline = current - self.idle_timeout
+        count = 0
+        for n in range(len(self.shards)):
+            shard = self.shards[n]
+            idle = list()
+            with self.locks[n]:
+                # least recently used first, stop at the first one in use
+                for session_id in shard:
+                    if shard[session_id].last_seen > deadline:
+                        break
+                    idle.append(session_id)
+                idle = [shard.pop(session_id) for session_id in idle]
+            count += len(idle)
+            if self.expired is not None:
+                for session in idle:
+                    self.expired(session)
+        return count
@@ -1,10 +1,13 @@
-from twisted.internet.protocol import Factory,Protocol
-from twisted.internet import reactor
-from twisted.python import log
-import sys, warnings, time
+import sys, warnings, threading
 from diameter import dictionary
 from diameter.peer import PeerStateMachine, PeerManager
-from diameter.protocol import DiameterMessage, DiameterAVP
+from diameter.protocol import DiameterMessage, DiameterAVP, FrozenAVP
+from diameter.timer import TimerQueue, now
+from diameter.resolver import resolver
+from diameter.ids import hopByHopIds, endToEndIds
+from diameter.dispatch import InlineDispatcher
+from diameter.session import SessionTable
+from diameter.metrics import Metrics
 import logging
 _log = logging.getLogger("sdp.diameter.stack")
 
@@ -48,6 +51,100 @@ class ApplicationListener:
         """Called on each stack tick"""
         pass
 
+    def onSessionExpired(self, session):
+        """session was idle for too long or evicted from a full table"""
+        pass
+
+    def onPause(self, peer):
+        """peer can't keep up, hold off sending to it until onResume"""
+        pass
+
+    def onResume(self, peer):
+        pass
+
+
+class PendingRequests:
+    """Requests waiting for an answer, keyed by (peer, hop-by-hop id).
+
+    Each entry holds the timer of its next retransmission, answering a
+    request cancels it."""
+    def __init__(self, timers):
+        self.timers = timers
+        self.requests = dict()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, peer, message, delay, callback):
+        """Call callback(peer, message) in delay seconds unless answered"""
+        key = (peer, message.hBh)
+        entry = self.requests.get(key)
+        if entry is not None:
+            entry[0].cancel()
+        else:
+            peer.outstanding += 1
+        timer = self.timers.schedule(delay, callback, peer, message)
+        self.requests[key] = (timer, message)
+
+    def pop(self, peer, hbh):
+        """Remove and return the request, None if it is not pending"""
+        entry = self.requests.pop((peer, hbh), None)
+        if entry is None:
+            return None
+        peer.outstanding -= 1
+        entry[0].cancel()
+        return entry[1]
+
+    def popPeer(self, peer):
+        """Remove and return every request pending on peer"""
+        keys = [key for key in self.requests if key[0] is peer]
+        return [self.pop(*key) for key in keys]
+
+
+class RequestTimeout(Exception):
+    """No answer arrived for a request sent with Stack.sendRequest"""
+    pass
+
+
+class PeerLost(RequestTimeout):
+    """The peer of a request went away before answering it"""
+    pass
+
+
+class PeerBusy(Exception):
+    """A request was dropped, too much is queued for its peer"""
+    pass
+
+
+class RequestStats:
+    """Answer latency, in seconds, of requests sent with Stack.sendRequest"""
+    def __init__(self):
+        self.answered = 0
+        self.timeouts = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, latency):
+        self.answered += 1
+        self.total += latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+    def average(self):
+        if self.answered:
+            return self.total / self.answered
+        return None
+
+
+class RetransmitPolicy:
+    def __init__(self, tries=3, interval=1):
+        # how many times a request is sent and the seconds between sends
+        self.tries = tries
+        self.interval = interval
+
 
 class Stack:
     def __init__(self, product_name="nuswit diameter", ip4_address="127.0.0.1"):
@@ -60,65 +157,115 @@ class Stack:
         self.ip4_address = ip4_address
         self.vendor_id = 0
         self.supported_vendors = list()
+        # Host-IP-Address values of our CER, ip4_address when empty
+        self.host_addresses = list()
         self.firmware_revision = 1
-        self.watchdog_seconds = None
-        self.hbh = 0
-        self.ete = 0
-
-        self.queued_messages = []
+        # Tw of RFC 3539, None disables the watchdog
+        self.watchdog_seconds = 30
+        # bytes waiting to be written to a peer before applications are
+        # paused and resumed, and past which messages are dropped
+        self.send_high_watermark = 1 << 20
+        self.send_low_watermark = 1 << 18
+        self.send_limit = 1 << 22
+        # decode incoming AVPs on first access, only pays off when few
+        # of them are read, see benchmarks/suite.py
+        self.lazy_decode = False
+        # low bits of every hop-by-hop/end-to-end id, see setWorker
+        self.worker_id = 0
+        self.worker_bits = 0
+        # hop-by-hop ids come from the peer a request is sent to
+        self.end_to_end = endToEndIds()
+
+        self.timers = TimerQueue()
+        self.pending = PendingRequests(self.timers)
+        # per application id, default_policy for the others
+        self.retransmit_policies = dict()
+        self.default_policy = RetransmitPolicy()
+        # (peer, hop-by-hop id) -> (callback, errback, sent at, timeout timer)
+        self.waiters = dict()
+        self.request_stats = RequestStats()
+        # creates the futures returned by sendRequest, set by the transport
+        self.future_factory = None
 
         self.identity = None
         self.realm = None
 
-    def nextHbH(self):
-        self.hbh += 1
-        return self.hbh
+        # application -> dispatcher running its handlers, inline by default
+        self.dispatchers = dict()
+        self.inline = InlineDispatcher()
+        # header application id -> (vendor, application, dispatcher), see buildRoutes
+        self.routes = dict()
+        # Session-Id -> Session, see enableSessions
+        self.sessions = None
+        # next sweep for idle sessions
+        self.session_timer = None
+        # see enableMetrics
+        self.metrics = None
+        # thread running the transport, set by it, sends from other
+        # threads are handed over to it
+        self.io_thread = None
+
+        # encoded once and shared by every message, each one is rebuilt
+        # when the configuration it was built from changes
+        self.origin_key = None
+        self.origin_avps = None
+        self.capabilities_key = None
+        self.capabilities_avps = None
+        self.application_avps = dict()
+        self.result_code_avps = dict()
+
+    def setWorker(self, index, count):
+        """Run as worker index of count processes sharing one identity,
+        the worker index goes in the low bits of our ids so no two
+        workers hand out the same one"""
+        bits = 0
+        while (1 << bits) < count:
+            bits += 1
+        self.worker_id = index
+        self.worker_bits = bits
+        self.end_to_end = endToEndIds(index, bits)
+
+    def newHopByHopIds(self):
+        """Hop-by-hop ids for a new connection"""
+        return hopByHopIds(self.worker_id, self.worker_bits)
+
+    def nextHbH(self, peer):
+        return peer.hop_by_hop.next()
+
+    def numberRequest(self, peer, message):
+        """Give message a hop-by-hop id of peer unless it has one already.
+        A single sequence per connection numbers every request pending on
+        it, so no two of them can share a (peer, hop-by-hop id) key."""
+        if message.request_flag and message.hbh_peer is not peer:
+            message.hBh = peer.hop_by_hop.next()
+            message.hbh_peer = peer
 
     def nextEtE(self):
-        self.ete += 1
-        return self.ete
+        return self.end_to_end.next()
 
-    def createRequest(self, application, code, auth=False, acct=False, vendor_id=None):
+    def createRequest(self, application, code, auth=False, acct=False, vendor_id=None, peer=None):
+        """New request, its hop-by-hop id comes from peer's ids when it
+        is known already, or from those of the peer it is sent to"""
         _log.debug("Creating Diameter message with command code %d", code)
         ret = DiameterMessage()
         ret.request_flag = True
         ret.eTe = self.nextEtE()
-        ret.hBh = self.nextHbH()
+        if peer is not None:
+            self.numberRequest(peer, ret)
         ret.application_id = application
         ret.command_code = code
 
         self.addOriginHostRealm(ret)
 
-        if vendor_id:
-            app_container = DiameterAVP()
-            app_container.setCode(260)
-            app_container.setMandatory(True)
-            tmp = DiameterAVP()
-            tmp.setCode(266)
-            tmp.setMandatory(True)
-            tmp.setInteger32(vendor_id)
-            app_container.addAVP(tmp)
-        else:
-            app_container = ret
-
-        if auth:
-            tmp = DiameterAVP()
-            tmp.setCode(258)
-            tmp.setMandatory(True)
-            tmp.setInteger32(application)
-            app_container.addAVP(tmp)
-        elif acct:
-            tmp = DiameterAVP()
-            tmp.setCode(258)
-            tmp.setMandatory(True)
-            tmp.setInteger32(application)
-            app_container.addAVP(tmp)
-
-        if app_container != ret:
-            ret.addAVP(app_container)
+        app_avp = self.applicationAVP(application, auth, acct, vendor_id)
+        if app_avp is not None:
+            ret.addAVP(app_avp)
 
         return ret
 
+    def createWatchdogRequest(self, peer=None):
+        return self.createRequest(0, 280, peer=peer)
+
     def createAnswer(self, req, ret_code=None):
         ret = DiameterMessage()
         ret.request_flag = False
@@ -129,31 +276,134 @@ class Stack:
         ret.command_code = req.command_code
   
         if ret_code:
-            tmp = DiameterAVP()
-            tmp.setCode(268)
-            tmp.setMandatory(True)
-            tmp.setInteger32(ret_code)
-            ret.addAVP(tmp)
+            ret.addAVP(self.resultCodeAVP(ret_code))
   
         self.addOriginHostRealm(ret)
 
         return ret
 
     def addOriginHostRealm(self, msg):
-        origin_host = DiameterAVP()
-        origin_host.setCode(264)
-        origin_host.setMandatory(True)
-        origin_host.setOctetString(self.identity)
-        msg.addAVP(origin_host)
+        key = (self.identity, self.realm)
+        if self.origin_key != key:
+            origin_host = DiameterAVP(264, mandatory=True)
+            origin_host.setOctetString(self.identity)
+            origin_realm = DiameterAVP(296, mandatory=True)
+            origin_realm.setOctetString(self.realm)
+            self.origin_avps = (FrozenAVP(origin_host), FrozenAVP(origin_realm))
+            self.origin_key = key
+
+        msg.addAVP(self.origin_avps[0])
+        msg.addAVP(self.origin_avps[1])
+
+    def resultCodeAVP(self, ret_code):
+        avp = self.result_code_avps.get(ret_code)
+        if avp is None:
+            tmp = DiameterAVP(268, mandatory=True)
+            tmp.setInteger32(ret_code)
+            avp = self.result_code_avps[ret_code] = FrozenAVP(tmp)
+        return avp
+
+    def applicationAVP(self, application, auth=False, acct=False, vendor_id=None):
+        """*-Application-Id of a request, wrapped in a
+        Vendor-Specific-Application-Id for vendor applications"""
+        key = (application, auth, acct, vendor_id)
+        if key in self.application_avps:
+            return self.application_avps[key]
+
+        app_id = None
+        if auth:
+            app_id = DiameterAVP(258, mandatory=True)
+            app_id.setInteger32(application)
+        elif acct:
+            app_id = DiameterAVP(259, mandatory=True)
+            app_id.setInteger32(application)
+
+        if vendor_id:
+            app_container = DiameterAVP(260, mandatory=True)
+            tmp = DiameterAVP(266, mandatory=True)
+            tmp.setInteger32(vendor_id)
+            app_container.addAVP(tmp)
+            if app_id is not None:
+                app_container.addAVP(app_id)
+            app_id = app_container
+
+        if app_id is not None:
+            app_id = FrozenAVP(app_id)
+        self.application_avps[key] = app_id
+        return app_id
+
+    def capabilitiesAVPs(self):
+        """Body of our CER, everything after Origin-Host/Origin-Realm"""
+        addresses = self.host_addresses or [self.ip4_address]
+        if self.io_thread is not None and self.inIOThread():
+            # never wait for DNS on the I/O thread, names still being
+            # resolved are left out until they are known
+            pending = [addr for addr in addresses if not resolver.isKnown(addr)]
+            for addr in pending:
+                _log.warning("Host address %s not resolved yet, left out of the capabilities", addr)
+                resolver.prefetch(addr)
+            addresses = [addr for addr in addresses if addr not in pending]
+        key = (self.vendor_id, self.product_name, self.firmware_revision, tuple(addresses),
+               tuple(self.supported_vendors), tuple(sorted(self.auth_apps)), tuple(sorted(self.acct_apps)))
+        if self.capabilities_key == key:
+            return self.capabilities_avps
+
+        avps = list()
+        # vendorid
+        tmp = DiameterAVP(266, mandatory=True)
+        tmp.setInteger32(self.vendor_id)
+        avps.append(tmp)
+
+        # productname
+        tmp = DiameterAVP(269, mandatory=True)
+        tmp.setOctetString(self.product_name)
+        avps.append(tmp)
+
+        # firmware
+        tmp = DiameterAVP(267, mandatory=True)
+        tmp.setInteger32(self.firmware_revision)
+        avps.append(tmp)
+
+        # host ip
+        for addr in addresses:
+            tmp = DiameterAVP(257, mandatory=True)
+            tmp.setAddress(addr)
+            avps.append(tmp)
+
+        # supported vendors
+        for vendor in self.supported_vendors:
+            supp = DiameterAVP(265, mandatory=True)
+            supp.setInteger32(vendor)
+            avps.append(supp)
+
+        # applications
+        for apps, code in [(self.auth_apps, 258), (self.acct_apps, 259)]:
+            for app in apps:
+                # Auth-Application-Id for authentication, Acct-Application-Id for accounting
+                _log.debug("CER %s-Application-Id %d", code == 258 and "Auth" or "Acct", app[1])
+                app_id = DiameterAVP(code, mandatory=True)
+                app_id.setInteger32(app[1])
+
+                if app[0]:
+                    tmp = DiameterAVP(260, mandatory=True)
+                    # vendor
+                    v = DiameterAVP(266, mandatory=True)
+                    v.setInteger32(app[0])
+                    tmp.addAVP(v)
+                    tmp.addAVP(app_id)
+                    avps.append(tmp)
+                else:
+                    avps.append(app_id)
 
-        origin_realm = DiameterAVP()
-        origin_realm.setCode(296)
-        origin_realm.setMandatory(True)
-        origin_realm.setOctetString(self.realm)
-        msg.addAVP(origin_realm)
+        self.capabilities_avps = [FrozenAVP(avp) for avp in avps]
+        self.capabilities_key = key
+        return self.capabilities_avps
 
-    def loadDictionary(self, dict_name, dict_file):
-        self.dictionaries[dict_name] = dictionary.DiameterDictionary(dict_file)
+    def loadDictionary(self, dict_name, dict_file, cache=False):
+        """dict_file is a path or a file object. With cache set and a path
+        given the compiled dictionary is kept next to dict_file, see
+        DiameterDictionary.loadCache."""
+        self.dictionaries[dict_name] = dictionary.DiameterDictionary(dict_file, cache)
 
     def getDictionary(self, dict_name):
         return self.dictionaries[dict_name]
@@ -161,11 +411,38 @@ class Stack:
     def addSupportedVendor(self, vendor):
         self.supported_vendors.append(vendor)
 
-    def registerAuthApplication(self, app, vendor, code):
+    def addHostAddress(self, addr):
+        """Advertise addr (IPv4/IPv6 literal or host name) in our CER"""
+        self.host_addresses.append(addr)
+        resolver.prefetch(addr)
+
+    def prefetchAddresses(self):
+        """Resolve our host addresses in the background so building the
+        CER never waits for DNS. Transports call it when they start."""
+        for addr in self.host_addresses or [self.ip4_address]:
+            resolver.prefetch(addr)
+
+    def registerAuthApplication(self, app, vendor, code, dispatcher=None):
         self.auth_apps[(vendor,code)] = app
+        self.setDispatcher(app, dispatcher)
+        self.buildRoutes()
 
-    def registerAcctApplication(self, app, vendor, code):
+    def registerAcctApplication(self, app, vendor, code, dispatcher=None):
         self.acct_apps[(vendor,code)] = app
+        self.setDispatcher(app, dispatcher)
+        self.buildRoutes()
+
+    def setDispatcher(self, app, dispatcher):
+        """Run the handlers of app with dispatcher, see diameter.dispatch.
+        None keeps the one app has, inline for a new app."""
+        if dispatcher is None:
+            return
+        dispatcher.setStack(self)
+        self.dispatchers[app] = dispatcher
+        self.buildRoutes()
+
+    def inIOThread(self):
+        return self.io_thread is None or threading.current_thread() is self.io_thread
 
     def registerPeerListener(self, pl):
         self.peer_listeners.append(pl)
@@ -174,18 +451,161 @@ class Stack:
         self.manager.registerPeerIO(pio)
 
     def clientV4Add(self, host, port):
+        """Connect to a peer. When building our CER would wait for DNS on
+        the I/O thread the connect is put off until our host addresses
+        are resolved, None is returned then instead of what the transport
+        returns. Without an I/O thread they are looked up right here."""
+        unresolved = self.unresolvedAddresses()
+        if unresolved and self.io_thread is None:
+            for addr in unresolved:
+                resolver.lookup(addr)
+        elif unresolved:
+            _log.debug("Resolving %s before connecting to %s:%d", unresolved, host, port)
+            self.whenResolved(unresolved, self.manager.clientV4Add, host, port)
+            return None
         return self.manager.clientV4Add(host, port)
 
+    def unresolvedAddresses(self):
+        return [addr for addr in self.host_addresses or [self.ip4_address]
+                if not resolver.isKnown(addr)]
+
+    def whenResolved(self, hosts, callback, *args):
+        """callback(*args) on the I/O thread once every one of hosts was
+        looked up, whether it resolved or not. The lookups call back on
+        resolver threads, so the transport must set io_thread and
+        implement callSoon."""
+        if self.io_thread is None:
+            raise RuntimeError("whenResolved needs a transport that sets Stack.io_thread "
+                               "and implements callSoon")
+        remaining = [len(hosts)]
+        lock = threading.Lock()
+
+        def resolved(addresses):
+            with lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                self.manager.io_cb.callSoon(callback, *args)
+
+        for host in hosts:
+            resolver.resolveAsync(host, resolved)
+
     def serverV4Add(self, host, port):
+        # our CEAs are built on the I/O thread and carry our host
+        # addresses, resolve them now
+        self.prefetchAddresses()
         return self.manager.serverV4Add(host, port)
 
     def serverV4Accept(self, base_peer, host, port):
         return self.manager.serverV4Accept(base_peer, host, port)
 
+    def setRetransmitPolicy(self, application_id, tries, interval):
+        """Send requests of application_id up to tries times,
+        interval seconds apart"""
+        self.retransmit_policies[application_id] = RetransmitPolicy(tries, interval)
+
+    def getRetransmitPolicy(self, message):
+        return self.retransmit_policies.get(message.application_id, self.default_policy)
+
+    def setRoutingStrategy(self, strategy, realm=None, application_id=None, vendor=0):
+        """Pick peers for application_id in realm with strategy, see
+        diameter.routing. Without realm it becomes the default."""
+        self.manager.setStrategy(strategy, realm, (vendor, application_id))
+
+    def selectPeer(self, realm, application_id, vendor=0, message=None):
+        """Peer to send a request of application_id to realm, None if no
+        peer of realm supporting it is available. Strategies keyed on
+        the session need message."""
+        return self.manager.selectPeer(realm, (vendor, application_id), message)
+
     def sendByPeer(self, peer, message, retransmission=True):
+        """False if message was dropped, see send_limit. From another
+        thread it is sent later on the I/O thread and True is returned."""
+        if not self.inIOThread():
+            self.manager.io_cb.callSoon(self.sendByPeer, peer, message, retransmission)
+            return True
+        self.numberRequest(peer, message)
+        if not self.manager.send(peer, message):
+            return False
         if message.request_flag and retransmission:
-            self.queued_messages.append((peer,message))
-        self.manager.send(peer, message)
+            policy = self.getRetransmitPolicy(message)
+            self.pending.add(peer, message, policy.interval, self.dispatch_messages)
+        return True
+
+    def sendRequestCallback(self, peer, message, callback, errback, timeout=None):
+        """Send message and call callback(answer) when its answer arrives,
+        or errback(RequestTimeout) after timeout seconds or once its
+        retransmissions are used up. The answer doesn't go to onAnswer.
+        Callbacks run on the I/O thread."""
+        if not self.inIOThread():
+            self.manager.io_cb.callSoon(self.sendRequestCallback, peer, message, callback, errback, timeout)
+            return
+        self.numberRequest(peer, message)
+        key = (peer, message.hBh)
+        timer = None
+        if timeout is not None:
+            timer = self.timers.schedule(timeout, self.requestTimeout, peer, message)
+        self.waiters[key] = (callback, errback, self.timers.clock(), timer)
+        if not self.sendByPeer(peer, message):
+            self.waiters.pop(key)
+            if timer is not None:
+                timer.cancel()
+            errback(PeerBusy("Send queue of peer %s is full" % peer))
+
+    def sendRequest(self, peer, message, timeout=None):
+        """Send message and return a future resolved with its answer.
+
+        The future comes from future_factory (the asyncio transport sets
+        one for its loop), concurrent.futures.Future otherwise or when
+        called off the I/O thread, so dispatcher threads can wait on it."""
+        factory = self.future_factory
+        if factory is None or not self.inIOThread():
+            from concurrent.futures import Future as factory
+        future = factory()
+
+        def answered(answer):
+            if not future.done():
+                future.set_result(answer)
+
+        def failed(error):
+            if not future.done():
+                future.set_exception(error)
+
+        self.sendRequestCallback(peer, message, answered, failed, timeout)
+        return future
+
+    def sendRequestDeferred(self, peer, message, timeout=None):
+        """Twisted flavour of sendRequest, returns a Deferred"""
+        from twisted.internet.defer import Deferred
+        d = Deferred()
+        self.sendRequestCallback(peer, message, d.callback, d.errback, timeout)
+        return d
+
+    def requestTimeout(self, peer, message):
+        """No answer for message, give up on it"""
+        if self.pending.pop(peer, message.hBh) is not None and self.metrics is not None:
+            self.metrics.timedOut(peer)
+        # not worth writing any more if the transport is still paused
+        self.manager.unqueue(peer, message)
+        waiter = self.waiters.pop((peer, message.hBh), None)
+        if waiter is not None:
+            if waiter[3] is not None:
+                waiter[3].cancel()
+            _log.error("Request %d to peer %s timed out", message.hBh, peer)
+            self.request_stats.timeouts += 1
+            waiter[1](RequestTimeout("No answer from peer %s for hop-by-hop id %d" % (peer, message.hBh)))
+
+    def answerWaiter(self, peer, message):
+        """Hand message to whoever is waiting for it, True if someone was"""
+        waiter = self.waiters.pop((peer, message.hBh), None)
+        if waiter is None:
+            return False
+        callback, errback, sent_at, timer = waiter
+        if timer is not None:
+            timer.cancel()
+        self.request_stats.record(self.timers.clock() - sent_at)
+        callback(message)
+        return True
 
     def registerPeer(self, peer, identity, realm, apps):
         r = self.manager.registerPeer(peer, identity, realm, apps)
@@ -196,6 +616,7 @@ class Stack:
                    apps)
         if r == True:
             _log.info("Successfully registered %s", peer)
+            peer.startWatchdog()
             for p in self.peer_listeners:
                 if peer.peer_type == PeerStateMachine.PEER_CLIENT:
                     p.connected(peer)
@@ -208,14 +629,98 @@ class Stack:
             return False
 
     def removePeer(self, peer):
-        self.manager.removerPeer(peer)
+        peer.stopWatchdog()
+        if not self.manager.removerPeer(peer):
+            return
         for p in self.peer_listeners:
             if peer.peer_type == PeerStateMachine.PEER_SERVER:
                 p.removed(peer)
 
+    def peerDown(self, peer):
+        """The watchdog gave up on peer: fail what is still waiting for
+        it instead of letting it time out, and drop the connection"""
+        self.failRequests(peer, "Peer %s is down" % peer)
+        self.removePeer(peer)
+        if self.metrics is not None:
+            self.metrics.peerGone(peer)
+        self.manager.io_cb.abort(peer)
+
+    def connectionLost(self, peer):
+        """Transports call it once the connection of peer is gone"""
+        self.failRequests(peer, "Connection to peer %s lost" % peer)
+        if peer.identity is not None:
+            self.removePeer(peer)
+        if self.metrics is not None:
+            self.metrics.peerGone(peer)
+
+    def failRequests(self, peer, reason):
+        """Give up on every request sent to peer, the errbacks of
+        sendRequest* get PeerLost right away so callers can fail over"""
+        for message in self.pending.popPeer(peer):
+            _log.debug("%s, dropping request %d", reason, message.hBh)
+        for key in [key for key in self.waiters if key[0] is peer]:
+            callback, errback, sent_at, timer = self.waiters.pop(key)
+            if timer is not None:
+                timer.cancel()
+            errback(PeerLost("%s, no answer for hop-by-hop id %d" % (reason, key[1])))
+
     def handleIncomingMessage(self, peer, message):
         _log.debug("Handling incoming Diameter message from peer %s", peer)
 
+        if message.request_flag and peer.paused:
+            # we can't even write to it, turn new work away
+            _log.debug("Peer %s is paused, answering too busy", peer)
+            answ = self.createAnswer(message, 3004)
+            answ.error_flag = True
+            self.sendByPeer(peer, answ)
+            return
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.dispatched(message)
+
+        if not message.request_flag:
+            # remove from retransmission queue
+            request = self.pending.pop(peer, message.hBh)
+            if request is not None and metrics is not None:
+                metrics.answered(request, now() - request.last_try)
+            if self.waiters and self.answerWaiter(peer, message):
+                return
+
+        route = self.routes.get(message.application_id)
+        if route is not None and route[0] != self.routeVendor(message):
+            # findRoute turns it away or finds the right application
+            route = None
+        if route is not None:
+            route = route[1:]
+        else:
+            route = self.findRoute(peer, message)
+            if route is None:
+                if message.request_flag:
+                    answ = self.createAnswer(message)
+                    answ.error_flag = True
+                    self.sendByPeer(peer, answ)
+                return
+        app, dispatcher = route
+
+        if self.sessions is not None:
+            message.session = self.sessions.lookup(message, app, peer)
+
+        dispatcher.dispatch(app, peer, message)
+
+    def routeVendor(self, message):
+        """Vendor findRoute would look message up under"""
+        container = message.findFirstAVP(260)
+        if container is None:
+            return 0
+        vendor = container.findFirstAVP(266)
+        if vendor is None:
+            return 0
+        return vendor.getInteger32()
+
+    def findRoute(self, peer, message):
+        """(application, dispatcher) of message from its application id
+        AVPs, for header application ids not in routes"""
         # first check for a vendor-specific application id
         vendorid = 0
         rapp_container = message.findFirstAVP(260)
@@ -225,7 +730,7 @@ class Stack:
                 vendorid = rvendorid.getInteger32()
         else:
             rapp_container = message
-        
+
         # look for auth/application ids
         rapp = rapp_container.findFirstAVP(258)
         if rapp == None:
@@ -236,41 +741,105 @@ class Stack:
         else:
             rvalue = message.application_id
 
-        if self.auth_apps.has_key((vendorid,rvalue)):
-            app = self.auth_apps[(vendorid,rvalue)]
-        elif self.acct_apps.has_key((vendorid,rvalue)):
-            app = self.acct_apps[(vendorid,rvalue)]
-        else:
-            _log.error("Peer %s: Application (%d,%d) not found" % (peer, vendorid, rvalue))
-            if message.request_flag:
-                answ = self.createAnswer(message)
-                answ.error_flag = True
-                self.sendByPeer(peer, answ)
-            return
-
-        if message.request_flag:
-            app.onRequest(peer, message)
-        else:
-            #remove from retransmission queue
-            self.queued_messages[:] = [x for x in self.queued_messages if not x[1].hBh == message.hBh]
-            app.onAnswer(peer, message)
+        app = self.auth_apps.get((vendorid, rvalue))
+        if app is None:
+            app = self.acct_apps.get((vendorid, rvalue))
+        if app is None:
+            _log.error("Peer %s: Application (%d,%d) not found", peer, vendorid, rvalue)
+            return None
+        return app, self.dispatchers.get(app, self.inline)
+
+    def buildRoutes(self):
+        """Map each header application id registered under a single
+        vendor by a single application to (vendor, application,
+        dispatcher). handleIncomingMessage takes the route for messages
+        of that vendor only, as findRoute would. Ids registered more
+        than once are left to findRoute."""
+        apps = dict()
+        for registered in (self.auth_apps, self.acct_apps):
+            for (vendor, code), app in registered.items():
+                apps.setdefault(code, list())
+                if (vendor, app) not in apps[code]:
+                    apps[code].append((vendor, app))
+        self.routes = dict()
+        for code, candidates in apps.items():
+            if len(candidates) == 1:
+                vendor, app = candidates[0]
+                self.routes[code] = (vendor, app, self.dispatchers.get(app, self.inline))
+
+    def enableMetrics(self):
+        """Start counting, see diameter.metrics"""
+        if self.metrics is None:
+            self.metrics = Metrics(self)
+        return self.metrics
+
+    def disableMetrics(self):
+        if self.metrics is not None:
+            self.metrics.close()
+            self.metrics = None
+
+    def enableSessions(self, idle_timeout=3600, max_sessions=1000000, shards=16, interval=10):
+        """Keep a session for each Session-Id, in message.session.
+        Idle ones are looked for every interval seconds. Calling it again
+        starts over with an empty table and the new settings."""
+        if self.session_timer is not None:
+            self.session_timer.cancel()
+        self.sessions = SessionTable(idle_timeout, max_sessions, shards,
+                                     self.sessionExpired, self.timers.clock)
+        self.session_timer = self.timers.schedule(interval, self.expireSessions, interval)
+
+    def expireSessions(self, interval):
+        count = self.sessions.expire()
+        if count:
+            _log.debug("Expired %d idle sessions", count)
+        self.session_timer = self.timers.schedule(interval, self.expireSessions, interval)
+
+    def endSession(self, session_id):
+        """Forget a session that is over, its Session object or None"""
+        if self.sessions is None:
+            return None
+        return self.sessions.remove(session_id)
+
+    def sessionExpired(self, session):
+        if session.app is not None:
+            session.app.onSessionExpired(session)
 
     def tick(self):
-        """Check retransmissions"""
-        self.queued_messages[:] = [x for x in self.queued_messages if self.dispatch_messages(*x)]
-        #tick all applications ( required so tick is called only once )
-        apps = list(set(self.auth_apps.values()).union(set(self.acct_apps.values())))
-        for app in apps:
+        """Run due timers (retransmissions, timeouts, watchdogs)"""
+        self.timers.run()
+        for app in self.getApplications():
             app.onTick()
 
+    def getApplications(self):
+        """Registered applications, each one once"""
+        return list(set(self.auth_apps.values()).union(set(self.acct_apps.values())))
+
+    def peerPaused(self, peer):
+        _log.warning("Peer %s can't keep up, pausing applications", peer)
+        for app in self.getApplications():
+            app.onPause(peer)
+
+    def peerResumed(self, peer):
+        _log.info("Peer %s caught up, resuming applications", peer)
+        for app in self.getApplications():
+            app.onResume(peer)
+
     def dispatch_messages(self, peer, msg):
-        now = int(time.time())
-        #3 seconds, 3 retries ( one per sec )
-        if msg.last_try < now - 1:
-            if msg.retries < 3:
-                _log.debug("Sending message to peer %s, attempt number %d", peer, msg.retries)
-                self.manager.send(peer,msg)
-                return True
-            else:
-                _log.error("Failed to send message to peer %s, after %d retries", peer, msg.retries)
-                return False
+        """Retransmission timer of msg expired"""
+        self.pending.pop(peer, msg.hBh)
+        policy = self.getRetransmitPolicy(msg)
+        # still waiting behind a paused transport, queue it only once
+        queued = msg in peer.tx_queue.messages
+        if msg.retries < policy.tries:
+            _log.debug("Sending message to peer %s, attempt number %d", peer, msg.retries)
+            if self.metrics is not None:
+                self.metrics.retransmitted(peer)
+            if queued or not self.manager.send(peer, msg):
+                # nothing written, count the attempt anyway so it times out
+                msg.retries += 1
+            self.pending.add(peer, msg, policy.interval, self.dispatch_messages)
+        else:
+            _log.error("Failed to send message to peer %s, after %d retries", peer, msg.retries)
+            if self.metrics is not None:
+                self.metrics.timedOut(peer)
+            self.requestTimeout(peer, msg)
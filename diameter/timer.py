@@ -0,0 +1,95 @@
+"""Timer queue driving retransmissions, timeouts and watchdogs
+
+Timers live in a heap ordered by deadline, so running the queue only
+touches the timers that are due. Cancelled timers stay in the heap until
+they come up, or until they outnumber the live ones and the heap is
+rebuilt.
+"""
+import heapq
+import itertools
+import time
+
+# monotonic where the interpreter has it
+now = getattr(time, 'monotonic', time.time)
+
+
+class Timer(object):
+    __slots__ = ('queue', 'deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, queue, deadline, callback, args):
+        self.queue = queue
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.queue.cancelled += 1
+            self.queue.maybeCompact()
+
+
+class TimerQueue:
+    def __init__(self, clock=now):
+        self.clock = clock
+        self.heap = []
+        self.cancelled = 0
+        # tie breaker so timers with the same deadline never get compared
+        self.sequence = itertools.count()
+        # called with the deadline of a timer scheduled ahead of all the
+        # others, lets an event loop wake up for it instead of polling
+        self.wakeup = None
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) delay seconds from now, returns the Timer"""
+        return self.scheduleAt(self.clock() + delay, callback, *args)
+
+    def scheduleAt(self, deadline, callback, *args):
+        timer = Timer(self, deadline, callback, args)
+        heapq.heappush(self.heap, (deadline, next(self.sequence), timer))
+        if self.wakeup is not None and self.heap[0][2] is timer:
+            self.wakeup(deadline)
+        return timer
+
+    def maybeCompact(self):
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+            self.compact()
+
+    def nextDeadline(self):
+        """Deadline of the first live timer, None if there is none"""
+        heap = self.heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+        if heap:
+            return heap[0][0]
+        return None
+
+    def run(self, current=None):
+        """Fire every timer due at current (default now).
+        Returns the number of callbacks run."""
+        if current is None:
+            current = self.clock()
+        heap = self.heap
+        fired = 0
+        while heap and heap[0][0] <= current:
+            timer = heapq.heappop(heap)[2]
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            # a fired timer can't be cancelled any more
+            timer.cancelled = True
+            timer.callback(*timer.args)
+            fired += 1
+        return fired
+
+    def compact(self):
+        # in place, run() may be iterating over the heap while a callback
+        # cancels timers
+        self.heap[:] = [entry for entry in self.heap if not entry[2].cancelled]
+        heapq.heapify(self.heap)
+        self.cancelled = 0
@@ -0,0 +1,127 @@
+"""Serve one port from several processes
+
+The stack is configured once (dictionaries, identity, applications) and
+forked into count workers, each one running the asyncio transport on its
+own SO_REUSEPORT listener so the kernel spreads incoming connections
+across them:
+
+    dstack = stack.Stack()
+    dstack.loadDictionary("base", "dictionary.xml")
+    dstack.registerAuthApplication(app, 0, 4)
+    workers.WorkerPool(dstack, "0.0.0.0", 3868, count=4).run()
+
+Each worker only sees its own connections, answers go back through the
+process that received the request.
+"""
+import errno
+import logging
+import os
+import signal
+import socket
+import time
+
+from diameter.resolver import resolver
+
+_log = logging.getLogger("sdp.diameter.workers")
+
+
+def cpuCount():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def describeStatus(status):
+    """How a child ended, from its os.wait status"""
+    if os.WIFSIGNALED(status):
+        return "was killed by signal %d" % os.WTERMSIG(status)
+    if os.WIFEXITED(status):
+        return "exited with status %d" % os.WEXITSTATUS(status)
+    return "ended with wait status %d" % status
+
+
+class WorkerPool:
+    def __init__(self, stack, host, port, count=None, setup=None, restart_delay=1):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+        self.stack = stack
+        self.host = host
+        self.port = port
+        self.count = count or cpuCount()
+        # setup(stack, index) runs in each worker before it listens
+        self.setup = setup
+        self.restart_delay = restart_delay
+        # pid -> worker index
+        self.workers = dict()
+        self.stopping = False
+
+    def run(self):
+        """Fork the workers and restart the ones that die until SIGTERM
+        or SIGINT, which are passed on to the workers"""
+        signal.signal(signal.SIGTERM, self.signalled)
+        signal.signal(signal.SIGINT, self.signalled)
+        for index in range(self.count):
+            self.spawn(index)
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            index = self.workers.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            _log.error("Worker %d (pid %d) %s, restarting", index, pid, describeStatus(status))
+            time.sleep(self.restart_delay)
+            self.spawn(index)
+
+    def stop(self):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def signalled(self, signum, frame):
+        _log.info("Signal %d, stopping workers", signum)
+        self.stop()
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = index
+            return pid
+
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            self.serve(index)
+        except Exception:
+            _log.exception("Worker %d failed", index)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def serve(self, index):
+        """Body of worker index"""
+        from diameter import aio
+
+        resolver.afterFork()
+        self.stack.setWorker(index, self.count)
+        if self.setup is not None:
+            self.setup(self.stack, index)
+
+        loop = aio.newEventLoop()
+        io = aio.AsyncioPeerIO(self.stack, loop, reuse_port=True)
+        self.stack.registerPeerIO(io)
+        self.stack.serverV4Add(self.host, self.port)
+        io.start()
+        _log.info("Worker %d (pid %d) serving %s:%d", index, os.getpid(), self.host, self.port)
+        loop.run_forever()
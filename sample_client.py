@@ -57,21 +57,14 @@ class SamplePeerListener(stack.PeerListener):
 class SamplePeerIOTwisted(Protocol):
     def __init__(self, peer):
         self.peer = peer
-        self.in_buffer = r''
-        self.in_pos = 0
 
     def connectionMade(self):
         self.peer._protocol = self
         self.peer.feed(None, 0)
 
     def dataReceived(self, data):
-        self.in_buffer += data
-        self.in_pos += len(data)
-        consumed = self.peer.feed(self.in_buffer, self.in_pos)
+        consumed = self.peer.receive(data)
         print("Consumed %d" % consumed)
-        if consumed > 0:
-            self.in_buffer = self.in_buffer[consumed:]
-            self.in_pos -= consumed
 
 
 class TwistedClientFactory(Factory):
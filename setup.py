@@ -1,11 +1,17 @@
 #!/usr/bin/python
 
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='sdp',
     version='0.1',
     description=('python diameter stack'),
     url='https://github.com/Metaswitch/sdp',
-    packages=['diameter']
+    packages=['diameter'],
+    extras_require={
+        # concurrent.futures for Stack.sendRequest, built in on python 3
+        ':python_version < "3"': ['futures'],
+        # asyncio transport, diameter.aio
+        'aio:python_version < "3"': ['trollius'],
+    }
 )
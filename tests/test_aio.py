@@ -0,0 +1,44 @@
+import unittest
+
+try:
+    from diameter import aio
+except ImportError:
+    aio = None
+from diameter import stack
+
+
+@unittest.skipIf(aio is None, "needs asyncio or trollius")
+class TimerDeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = aio.newEventLoop()
+        self.stack = stack.Stack()
+        self.io = aio.AsyncioPeerIO(self.stack, self.loop, tick_interval=60)
+        self.stack.registerPeerIO(self.io)
+        self.io.start()
+
+    def tearDown(self):
+        self.io.stop()
+        self.loop.close()
+
+    def test_timer_runs_at_its_deadline(self):
+        fired = []
+        self.stack.timers.schedule(0.05, fired.append, True)
+        self.loop.call_later(0.5, self.loop.stop)
+        started = self.loop.time()
+        self.loop.call_at(started + 0.1, lambda: fired.append(self.loop.time() - started))
+        self.loop.run_forever()
+        self.assertEqual(fired[0], True)
+        self.assertTrue(fired[1] >= 0.1)
+
+    def test_earlier_timer_rearms(self):
+        fired = []
+        self.stack.timers.schedule(30, fired.append, 30)
+        self.stack.timers.schedule(0.01, fired.append, 0.01)
+        self.loop.call_later(0.2, self.loop.stop)
+        self.loop.run_forever()
+        self.assertEqual(fired, [0.01])
+        self.assertEqual(self.io.timer_deadline, self.stack.timers.nextDeadline())
+
+
+if __name__ == '__main__':
+    unittest.main()
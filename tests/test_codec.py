@@ -0,0 +1,116 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from diameter.codec import CODECS, TimeCodec
+from diameter.dictionary import DiameterDictionary
+from diameter.protocol import DiameterAVP
+
+XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<dictionary>
+  <vendor vendor-id="None" code="0" name="None"/>
+  <typedefn type-name="Integer32"/>
+  <typedefn type-name="Time" type-parent="OctetString"/>
+  <typedefn type-name="Address" type-parent="OctetString"/>
+  <typedefn type-name="UTF8String" type-parent="OctetString"/>
+  <typedefn type-name="Local-Name" type-parent="UTF8String"/>
+  <base uri="x">
+    <avp name="Acct-Input-Offset" code="9001"><type type-name="Integer32"/></avp>
+    <avp name="Termination-Cause" code="295"><type type-name="Enumerated"/>
+      <enum name="DIAMETER_LOGOUT" code="1"/></avp>
+    <avp name="Event-Timestamp" code="55"><type type-name="Time"/></avp>
+    <avp name="Host-IP-Address" code="257"><type type-name="Address"/></avp>
+    <avp name="Subscriber-Name" code="9002"><type type-name="Local-Name"/></avp>
+  </base>
+</dictionary>
+"""
+
+
+def reparse(avp):
+    copy = DiameterAVP()
+    copy.parseFromBuffer(avp.getWire(), 0)
+    return copy
+
+
+class TypedCodecTest(unittest.TestCase):
+    def roundTrip(self, type_name, value):
+        avp = DiameterAVP(1, codec=CODECS[type_name]).withValue(value)
+        copy = reparse(avp)
+        copy.codec = CODECS[type_name]
+        return avp, copy.getValue()
+
+    def test_signed_integer32(self):
+        avp, value = self.roundTrip("Integer32", -5)
+        self.assertEqual(value, -5)
+        self.assertEqual(avp.avp_data, b"\xff\xff\xff\xfb")
+
+    def test_signed_enumerated(self):
+        self.assertEqual(self.roundTrip("Enumerated", -1)[1], -1)
+        self.assertEqual(self.roundTrip("Enumerated", 2001)[1], 2001)
+
+    def test_unsigned32_top_bit(self):
+        self.assertEqual(self.roundTrip("Unsigned32", 0xfffffffe)[1], 0xfffffffe)
+
+    def test_time_before_2036(self):
+        self.assertEqual(self.roundTrip("Time", 1500000000)[1], 1500000000)
+
+    def test_time_wraps_after_2036(self):
+        # 2036-02-07T06:28:16Z is NTP second 2**32, it encodes as 0
+        wrap = 2 ** 32 - TimeCodec.NTP_OFFSET
+        avp, value = self.roundTrip("Time", wrap)
+        self.assertEqual(avp.avp_data, b"\0\0\0\0")
+        self.assertEqual(value, wrap)
+        self.assertEqual(self.roundTrip("Time", wrap + 86400)[1], wrap + 86400)
+
+    def test_ipv4_address(self):
+        avp, value = self.roundTrip("Address", "192.0.2.1")
+        self.assertEqual(avp.avp_data, b"\0\x01\xc0\0\x02\x01")
+        self.assertEqual(value, "192.0.2.1")
+
+    def test_ipv6_address(self):
+        avp, value = self.roundTrip("Address", "2001:db8::1")
+        self.assertEqual(avp.type_size, 18)
+        self.assertEqual(avp.avp_data[:2], b"\0\x02")
+        self.assertEqual(value, "2001:db8::1")
+
+
+class DictionaryCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "dictionary.xml")
+        with open(self.path, "wb") as f:
+            f.write(XML)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertCodecs(self, d):
+        self.assertIs(d.getAVPDefinition("Acct-Input-Offset").codec, CODECS["Integer32"])
+        self.assertIs(d.getAVPDefinition("Termination-Cause").codec, CODECS["Enumerated"])
+        self.assertIs(d.getAVPDefinition("Event-Timestamp").codec, CODECS["Time"])
+        self.assertIs(d.getAVPDefinition("Host-IP-Address").codec, CODECS["Address"])
+        # derived types resolve through their typedefn parents
+        self.assertIs(d.getAVPDefinition("Subscriber-Name").codec, CODECS["UTF8String"])
+        avp = d.getAVPDefinition("Acct-Input-Offset").newAVP().withValue(-3)
+        self.assertEqual(avp.getValue(), -3)
+
+    def test_loaded(self):
+        self.assertCodecs(DiameterDictionary(self.path))
+
+    def test_cached(self):
+        DiameterDictionary(self.path, cache=True)
+        d = DiameterDictionary(self.path)
+        self.assertTrue(d.loadCache(self.path))
+        self.assertCodecs(d)
+
+    def test_definition_pickles_codec_by_name(self):
+        avp_def = DiameterDictionary(self.path).getAVPDefinition("Event-Timestamp")
+        copy = pickle.loads(pickle.dumps(avp_def, pickle.HIGHEST_PROTOCOL))
+        self.assertIs(copy.codec, CODECS["Time"])
+        self.assertIs(avp_def.codec, CODECS["Time"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from diameter.dictionary import DiameterDictionary
+
+XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<dictionary>
+  <vendor vendor-id="None" code="0" name="None"/>
+  <vendor vendor-id="TGPP" code="10415" name="3GPP"/>
+  <base uri="x">
+    <avp name="Result-Code" code="268" mandatory="must"><type type-name="Unsigned32"/>
+      <enum name="DIAMETER_SUCCESS" code="2001"/></avp>
+  </base>
+  <application id="4" name="Credit Control">
+    <command name="Credit-Control" code="272" vendor-id="None"/>
+    <avp name="Charging-Rule-Name" code="1005" vendor-id="TGPP"><type type-name="OctetString"/></avp>
+  </application>
+</dictionary>
+"""
+
+
+class DictionaryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "dictionary.xml")
+        with open(self.path, "wb") as f:
+            f.write(XML)
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def assertLoaded(self, d):
+        self.assertEqual(d.getEnumCode("Result-Code", "DIAMETER_SUCCESS"), 2001)
+        self.assertEqual(d.getAVPDefinition("Charging-Rule-Name").vendor_id, 10415)
+        self.assertEqual(d.getCommandDefinition("Credit-Control").application_id, 4)
+
+    def test_file_object(self):
+        self.assertLoaded(DiameterDictionary(BytesIO(XML), cache=True))
+        self.assertEqual(os.listdir(self.dir), ["dictionary.xml"])
+
+    def test_no_cache_by_default(self):
+        self.assertLoaded(DiameterDictionary(self.path))
+        self.assertFalse(os.path.exists(self.path + ".cache"))
+
+    def test_cache_is_reused(self):
+        DiameterDictionary(self.path, cache=True)
+        self.assertEqual(os.stat(self.path + ".cache").st_mode & 0o077, 0)
+        d = DiameterDictionary(self.path)
+        self.assertTrue(d.loadCache(self.path))
+        self.assertLoaded(d)
+
+    def test_cache_writable_by_others_is_ignored(self):
+        DiameterDictionary(self.path, cache=True)
+        os.chmod(self.path + ".cache", 0o666)
+        d = DiameterDictionary(self.path)
+        self.assertFalse(d.loadCache(self.path))
+        self.assertLoaded(DiameterDictionary(self.path, cache=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
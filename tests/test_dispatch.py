@@ -0,0 +1,97 @@
+import os
+import threading
+import unittest
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from diameter import stack
+from diameter.dispatch import ThreadDispatcher
+from diameter.peer import Peer, PeerIOCallbacks, PeerStateMachine
+
+
+class LoopIO(PeerIOCallbacks):
+    """Runs callSoon callbacks when the test pumps it, like a loop would"""
+    def __init__(self):
+        self.calls = queue.Queue()
+        self.write_threads = []
+
+    def callSoon(self, callback, *args):
+        self.calls.put((callback, args))
+
+    def flushLater(self, peer):
+        peer.manager.flush(peer)
+
+    def write(self, peer, data, length):
+        self.write_threads.append(threading.current_thread())
+
+    def runOne(self):
+        callback, args = self.calls.get(timeout=5)
+        callback(*args)
+
+
+class Answering(stack.ApplicationListener):
+    def onRequest(self, peer, request):
+        self.stack.sendByPeer(peer, self.stack.createAnswer(request, 2001))
+
+
+class ThreadDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = stack.Stack()
+        self.stack.identity = "host.example"
+        self.stack.realm = "example"
+        self.stack.watchdog_seconds = None
+        self.io = LoopIO()
+        self.stack.registerPeerIO(self.io)
+        self.dispatcher = ThreadDispatcher(2)
+        app = Answering()
+        app.setStack(self.stack)
+        self.stack.registerAuthApplication(app, 0, 4, self.dispatcher)
+        self.peer = Peer(self.stack.manager, PeerStateMachine.PEER_SERVER)
+        self.stack.registerPeer(self.peer, "peer.example", "example", {(0, 4): True})
+
+    def tearDown(self):
+        self.dispatcher.close()
+
+    def test_refused_without_io_thread(self):
+        request = self.stack.createRequest(4, 272, auth=True, peer=self.peer)
+        with self.assertRaises(RuntimeError):
+            self.stack.handleIncomingMessage(self.peer, request)
+
+    def test_answers_are_written_on_the_io_thread(self):
+        self.stack.io_thread = threading.current_thread()
+        request = self.stack.createRequest(4, 272, auth=True, peer=self.peer)
+        self.stack.handleIncomingMessage(self.peer, request)
+        self.io.runOne()
+        self.assertEqual(self.io.write_threads, [threading.current_thread()])
+
+    def test_threads_start_with_the_first_message(self):
+        self.assertEqual(self.dispatcher.threads, [])
+        self.stack.io_thread = threading.current_thread()
+        self.stack.handleIncomingMessage(self.peer, self.stack.createRequest(4, 272, auth=True, peer=self.peer))
+        self.io.runOne()
+        self.assertEqual(len(self.dispatcher.threads), 2)
+
+    def test_forked_worker_starts_its_own_threads(self):
+        self.stack.io_thread = threading.current_thread()
+        self.stack.handleIncomingMessage(self.peer, self.stack.createRequest(4, 272, auth=True, peer=self.peer))
+        self.io.runOne()
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                self.stack.io_thread = threading.current_thread()
+                self.io.write_threads = []
+                self.stack.handleIncomingMessage(self.peer, self.stack.createRequest(4, 272, auth=True, peer=self.peer))
+                self.io.runOne()
+                if self.io.write_threads == [threading.current_thread()]:
+                    status = 0
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+from diameter import stack
+from diameter.metrics import escape
+from diameter.peer import Peer, PeerIOCallbacks, PeerStateMachine
+
+
+class NullIO(PeerIOCallbacks):
+    def write(self, peer, data, length):
+        pass
+
+
+class PeerMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = stack.Stack()
+        self.stack.identity = "host.example"
+        self.stack.realm = "example"
+        self.stack.registerPeerIO(NullIO())
+        self.metrics = self.stack.enableMetrics()
+
+    def tearDown(self):
+        self.stack.disableMetrics()
+
+    def connect(self, identity):
+        peer = Peer(self.stack.manager, PeerStateMachine.PEER_SERVER)
+        peer.identity = identity
+        self.stack.sendByPeer(peer, self.stack.createWatchdogRequest(peer), False)
+        return peer
+
+    def test_same_identity_twice(self):
+        self.connect("peer.example")
+        self.connect("peer.example")
+        peers = self.metrics.snapshot()['peers']
+        self.assertEqual(len(peers), 2)
+        self.assertEqual([v['peer'] for v in peers.values()], ["peer.example"] * 2)
+        self.assertEqual([v['messages_out'] for v in peers.values()], [1, 1])
+
+    def test_reconnects_dont_accumulate(self):
+        for n in range(5):
+            self.stack.connectionLost(self.connect("peer.example"))
+        self.assertEqual(self.metrics.peers, {})
+        self.assertEqual(self.metrics.snapshot()['peers'], {})
+
+    def test_label_escaping(self):
+        self.assertEqual(escape('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+        self.connect('bad"peer\n')
+        text = self.metrics.render()
+        self.assertTrue('peer="bad\\"peer\\n",connection="1"' in text)
+        for line in text.splitlines():
+            self.assertEqual(len(line.rsplit(' ', 1)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import unittest
+
+from diameter import stack
+from diameter.peer import Peer, PeerIOCallbacks, PeerStateMachine
+from diameter.protocol import DiameterAVP, DiameterMessage
+
+
+class RecordingIO(PeerIOCallbacks):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, peer, data, length):
+        self.writes.append((data, length))
+
+
+def splitMessages(data):
+    messages = []
+    offset = 0
+    while offset < len(data):
+        msg = DiameterMessage()
+        offset += msg.parseFromBuffer(data, offset)
+        messages.append(msg)
+    return messages
+
+
+class FlushTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = stack.Stack()
+        self.stack.identity = "host.example"
+        self.stack.realm = "example"
+        self.io = RecordingIO()
+        self.stack.registerPeerIO(self.io)
+        self.peer = Peer(self.stack.manager, PeerStateMachine.PEER_SERVER)
+
+    def test_messages_changed_after_queuing(self):
+        manager = self.stack.manager
+        manager.pauseWriting(self.peer)
+        first = self.stack.createRequest(4, 272, auth=True)
+        second = self.stack.createRequest(4, 272, auth=True)
+        manager.send(self.peer, first)
+        manager.send(self.peer, second)
+        first.addAVP(DiameterAVP(263).withOctetString("added;after;queuing"))
+        second.hBh = 42
+        manager.resumeWriting(self.peer)
+
+        self.assertEqual(len(self.io.writes), 1)
+        data, length = self.io.writes[0]
+        self.assertEqual(length, len(data))
+        self.assertEqual(length, first.message_length + second.message_length)
+        written = splitMessages(data)
+        self.assertEqual(len(written), 2)
+        self.assertEqual(written[0].findFirstAVP(263).getOctetString(), "added;after;queuing")
+        self.assertEqual(written[1].hBh, 42)
+        self.assertEqual(self.peer.tx_queue.size, 0)
+
+
+class ReceiveTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = stack.Stack()
+        self.stack.identity = "host.example"
+        self.stack.realm = "example"
+        self.stack.watchdog_seconds = None
+        self.stack.registerPeerIO(RecordingIO())
+        self.peer = Peer(self.stack.manager, PeerStateMachine.PEER_SERVER)
+        self.received = []
+        self.peer.fsm.run = self.handle
+        self.fail_on = None
+        self.wires = []
+        for n in range(3):
+            msg = self.stack.createRequest(4, 272, auth=True, peer=self.peer)
+            msg.addAVP(DiameterAVP(263).withOctetString("session;%d" % n))
+            self.wires.append(msg.getBytes())
+
+    def handle(self, consumed, msg):
+        if msg is None:
+            return
+        self.received.append(msg.hBh)
+        if msg.hBh == self.fail_on:
+            raise RuntimeError("handler failed")
+
+    def ids(self, *numbers):
+        return [self.hbh(n) for n in numbers]
+
+    def hbh(self, n):
+        msg = DiameterMessage()
+        msg.parseFromBuffer(self.wires[n])
+        return msg.hBh
+
+    def test_byte_by_byte(self):
+        stream = b"".join(self.wires)
+        for i in range(len(stream)):
+            self.assertTrue(self.peer.receive(stream[i:i + 1]) >= 0)
+        self.assertEqual(self.received, self.ids(0, 1, 2))
+        self.assertEqual(len(self.peer.rx_buffer), 0)
+
+    def test_partial_reads(self):
+        stream = b"".join(self.wires)
+        cut = len(self.wires[0]) + 10
+        self.assertEqual(self.peer.receive(stream[:cut]), len(self.wires[0]))
+        self.assertEqual(self.received, self.ids(0))
+        self.assertEqual(len(self.peer.rx_buffer), 10)
+        self.peer.receive(stream[cut:])
+        self.assertEqual(self.received, self.ids(0, 1, 2))
+        self.assertEqual(len(self.peer.rx_buffer), 0)
+
+    def test_handler_raising_midway(self):
+        self.fail_on = self.hbh(1)
+        with self.assertRaises(RuntimeError):
+            self.peer.receive(b"".join(self.wires))
+        self.assertEqual(self.received, self.ids(0, 1))
+        self.fail_on = None
+        self.peer.receive(b"")
+        self.assertEqual(self.received, self.ids(0, 1, 2))
+
+    def test_short_length_is_a_protocol_error(self):
+        wire = bytearray(self.wires[0])
+        wire[1:4] = b"\0\0\x08"
+        self.assertEqual(self.peer.receive(bytes(wire)), -1)
+        self.assertEqual(self.received, [])
+
+    def test_zero_length_avp_is_a_protocol_error(self):
+        wire = bytearray(self.wires[0][:28])
+        wire[1:4] = b"\0\0\x1c"
+        wire[24:28] = b"\x40\0\0\0"
+        self.assertEqual(self.peer.receive(bytes(wire)), -1)
+        self.assertEqual(self.received, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
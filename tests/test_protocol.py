@@ -0,0 +1,113 @@
+import unittest
+
+from diameter.protocol import DiameterAVP, DiameterMessage
+
+
+def sampleMessage():
+    msg = DiameterMessage()
+    msg.request_flag = True
+    msg.application_id = 4
+    msg.command_code = 272
+    msg.hBh = 1
+    msg.eTe = 2
+    msg.addAVP(DiameterAVP(263, mandatory=True).withOctetString("client;1;1"))
+    msg.addAVP(DiameterAVP(268, mandatory=True).withInteger32(2001))
+    msg.addAVP(DiameterAVP(1032, 10415, mandatory=True).withInteger32(1004))
+    return msg
+
+
+def parse(wire, lazy):
+    msg = DiameterMessage()
+    msg.parseFromBuffer(wire, 0, lazy)
+    return msg
+
+
+class LazyDecodeTest(unittest.TestCase):
+    def test_untouched_bytes_are_reused(self):
+        wire = sampleMessage().getBytes()
+        msg = parse(wire, True)
+        msg.hBh = 7
+        self.assertEqual(parse(msg.getBytes(), False).hBh, 7)
+        self.assertEqual(msg.getBytes()[20:], wire[20:])
+
+    def test_avp_changed_in_place_is_sent(self):
+        msg = parse(sampleMessage().getBytes(), True)
+        msg.findFirstAVP(268).setInteger32(5012)
+        self.assertEqual(parse(msg.getBytes(), False).findFirstAVP(268).getInteger32(), 5012)
+
+    def test_avp_resized_in_place_keeps_framing(self):
+        msg = parse(sampleMessage().getBytes(), True)
+        msg.findFirstAVP(263).setOctetString("a much longer session id;1;1")
+        wire = msg.getBytes()
+        again = parse(wire, False)
+        self.assertEqual(again.message_length, len(wire))
+        self.assertEqual(again.findFirstAVP(263).getOctetString(), "a much longer session id;1;1")
+        self.assertEqual(again.findFirstAVP(1032, 10415).getInteger32(), 1004)
+
+    def test_lazy_and_eager_agree(self):
+        wire = sampleMessage().getBytes()
+        lazy, eager = parse(wire, True), parse(wire, False)
+        for code, vendor in ((263, 0), (268, 0), (1032, 10415)):
+            self.assertEqual(lazy.findFirstAVP(code, vendor).getOctetString(),
+                             eager.findFirstAVP(code, vendor).getOctetString())
+
+
+class GroupEncodingTest(unittest.TestCase):
+    def test_child_resized_after_add(self):
+        child = DiameterAVP(444).withOctetString("short")
+        group = DiameterAVP(443).withAVP(child)
+        msg = sampleMessage()
+        msg.addAVP(group)
+        child.setOctetString("a much longer subscription id")
+        wire = msg.getBytes()
+        self.assertEqual(len(wire), msg.message_length)
+        found = parse(wire, False).findFirstAVP(443).findFirstAVP(444)
+        self.assertEqual(found.getOctetString(), "a much longer subscription id")
+
+    def test_opened_group_child_changed(self):
+        msg = sampleMessage()
+        msg.addAVP(DiameterAVP(443).withAVP(DiameterAVP(450).withInteger32(1)))
+        received = parse(msg.getBytes(), False)
+        received.findFirstAVP(443).findFirstAVP(450).setInteger32(2)
+        found = parse(received.getBytes(), False).findFirstAVP(443).findFirstAVP(450)
+        self.assertEqual(found.getInteger32(), 2)
+
+    def test_data_of_the_wrong_size(self):
+        avp = DiameterAVP(268).withInteger32(2001)
+        avp.avp_data += "\0\0\0\0"
+        self.assertRaises(ValueError, avp.getWire)
+
+    def test_buffer_too_small(self):
+        msg = sampleMessage()
+        buf = bytearray(msg.message_length - 4)
+        self.assertRaises(ValueError, msg.encodeInto, buf, 0)
+        self.assertEqual(len(buf), msg.message_length - 4)
+
+
+class MalformedTest(unittest.TestCase):
+    def zeroLength(self):
+        # header of 20 plus one avp header claiming a length of 0
+        wire = bytearray(sampleMessage().getBytes()[:28])
+        wire[1:4] = b"\0\0\x1c"
+        wire[24:28] = b"\x40\0\0\0"
+        return bytes(wire)
+
+    def test_zero_length_avp(self):
+        for lazy in (False, True):
+            self.assertRaises(ValueError, parse, self.zeroLength(), lazy)
+
+    def test_avp_past_the_message(self):
+        wire = bytearray(sampleMessage().getBytes())
+        wire[25:28] = b"\0\x0f\xff"
+        for lazy in (False, True):
+            self.assertRaises(ValueError, parse, bytes(wire), lazy)
+
+    def test_zero_length_avp_in_group(self):
+        group = DiameterAVP(873, 10415)
+        group.avp_data = b"\0\0\x03\xf4\0\0\0\0"
+        group.type_size = 8
+        self.assertRaises(ValueError, group.getGroup)
+
+
+if __name__ == '__main__':
+    unittest.main()
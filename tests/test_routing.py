@@ -0,0 +1,169 @@
+import random
+import unittest
+
+from diameter import stack
+from diameter.peer import Peer, PeerIOCallbacks, PeerStateMachine
+from diameter.protocol import DiameterAVP, DiameterMessage
+from diameter.routing import PeerList, RoundRobin, LeastOutstanding, Weighted, ConsistentHash
+
+
+class FakePeer:
+    def __init__(self, identity, weight=1, outstanding=0):
+        self.identity = identity
+        self.weight = weight
+        self.outstanding = outstanding
+        self.available = True
+
+    def isAvailable(self):
+        return self.available
+
+    def __repr__(self):
+        return self.identity
+
+
+def peerList(*peers):
+    peers_list = PeerList()
+    for peer in peers:
+        peers_list.add(peer)
+    return peers_list
+
+
+def sessionMessage(session):
+    msg = DiameterMessage()
+    msg.addAVP(DiameterAVP(263).withOctetString(session))
+    return msg
+
+
+class RoundRobinTest(unittest.TestCase):
+    def test_cycles_over_available_peers(self):
+        a, b, c = FakePeer("a"), FakePeer("b"), FakePeer("c")
+        peers = peerList(a, b, c)
+        strategy = RoundRobin()
+        self.assertEqual([strategy.select(peers, None) for n in range(4)], [a, b, c, a])
+        b.available = False
+        self.assertEqual([strategy.select(peers, None) for n in range(3)], [c, a, c])
+
+    def test_none_available(self):
+        a = FakePeer("a")
+        a.available = False
+        self.assertEqual(RoundRobin().select(peerList(a), None), None)
+        self.assertEqual(RoundRobin().select(peerList(), None), None)
+
+
+class LeastOutstandingTest(unittest.TestCase):
+    def test_fewer_outstanding_wins(self):
+        busy, idle = FakePeer("busy", outstanding=10), FakePeer("idle", outstanding=1)
+        peers = peerList(busy, idle)
+        for n in range(20):
+            self.assertIs(LeastOutstanding().select(peers, None), idle)
+
+    def test_skips_unavailable(self):
+        random.seed(1)
+        peers = peerList(*[FakePeer(str(n), outstanding=n) for n in range(5)])
+        for peer in peers[:4]:
+            peer.available = False
+        for n in range(20):
+            self.assertIs(LeastOutstanding().select(peers, None), peers[4])
+        peers[4].available = False
+        self.assertEqual(LeastOutstanding().select(peers, None), None)
+
+    def test_single_peer(self):
+        a = FakePeer("a")
+        self.assertIs(LeastOutstanding().select(peerList(a), None), a)
+        a.available = False
+        self.assertEqual(LeastOutstanding().select(peerList(a), None), None)
+
+
+class WeightedTest(unittest.TestCase):
+    def test_in_proportion_to_weight(self):
+        random.seed(2)
+        heavy, light = FakePeer("heavy", weight=9), FakePeer("light", weight=1)
+        peers = peerList(heavy, light)
+        picks = [Weighted().select(peers, None) for n in range(1000)]
+        self.assertTrue(850 < picks.count(heavy) < 950)
+
+    def test_zero_weight_never_picked_while_others_are(self):
+        a, b = FakePeer("a", weight=0), FakePeer("b")
+        peers = peerList(a, b)
+        for n in range(20):
+            self.assertIs(Weighted().select(peers, None), b)
+        b.available = False
+        self.assertIs(Weighted().select(peers, None), a)
+
+    def test_table_dropped_on_changes(self):
+        strategy = Weighted()
+        a, b = FakePeer("a"), FakePeer("b", weight=0)
+        peers = peerList(a)
+        strategy.select(peers, None)
+        self.assertIn(strategy, peers.state)
+        peers.add(b)
+        self.assertEqual(peers.state, {})
+        strategy.select(peers, None)
+        self.assertEqual(peers.state[strategy], ([1, 1], 1))
+        peers.discard(a)
+        self.assertEqual(peers.state, {})
+        self.assertFalse(peers.discard(a))
+
+
+class ConsistentHashTest(unittest.TestCase):
+    def test_session_sticks_to_a_peer(self):
+        peers = peerList(*[FakePeer("peer%d" % n) for n in range(4)])
+        strategy = ConsistentHash()
+        for n in range(20):
+            msg = sessionMessage("client;%d" % n)
+            owner = strategy.select(peers, msg)
+            self.assertIs(strategy.select(peers, msg), owner)
+
+    def test_unavailable_owner_moves_only_its_sessions(self):
+        peers = peerList(*[FakePeer("peer%d" % n) for n in range(4)])
+        strategy = ConsistentHash()
+        messages = [sessionMessage("client;%d" % n) for n in range(50)]
+        owners = [strategy.select(peers, msg) for msg in messages]
+        gone = owners[0]
+        gone.available = False
+        for msg, owner in zip(messages, owners):
+            peer = strategy.select(peers, msg)
+            self.assertIsNot(peer, gone)
+            if owner is not gone:
+                self.assertIs(peer, owner)
+
+    def test_ring_rebuilt_on_changes(self):
+        a, b = FakePeer("a"), FakePeer("b")
+        peers = peerList(a)
+        strategy = ConsistentHash(replicas=4)
+        msg = sessionMessage("client;1")
+        self.assertIs(strategy.select(peers, msg), a)
+        peers.add(b)
+        self.assertEqual(peers.state, {})
+        strategy.select(peers, msg)
+        self.assertEqual(len(peers.state[strategy][0]), 8)
+        peers.discard(a)
+        self.assertIs(strategy.select(peers, msg), b)
+
+    def test_no_session_uses_fallback(self):
+        a, b = FakePeer("a"), FakePeer("b")
+        strategy = ConsistentHash(fallback=RoundRobin())
+        peers = peerList(a, b)
+        self.assertEqual([strategy.select(peers, DiameterMessage()) for n in range(3)], [a, b, a])
+        self.assertEqual(strategy.select(peerList(), sessionMessage("client;1")), None)
+
+
+class ReweightTest(unittest.TestCase):
+    def test_set_weight_drops_strategy_state(self):
+        s = stack.Stack()
+        s.identity = "host.example"
+        s.realm = "example"
+        s.registerPeerIO(PeerIOCallbacks())
+        peer = Peer(s.manager, PeerStateMachine.PEER_SERVER)
+        s.registerPeer(peer, "peer.example", "example", {(0, 4): True})
+        peers = s.manager.realms["example"].applications[(0, 4)]
+        strategy = Weighted()
+        strategy.select(peers, None)
+        self.assertIn(strategy, peers.state)
+        s.manager.setWeight(peer, 5)
+        self.assertEqual(peers.state, {})
+        self.assertEqual(strategy.build(peers), ([5], 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
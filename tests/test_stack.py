@@ -0,0 +1,365 @@
+import socket
+import threading
+import unittest
+
+from diameter import stack
+from diameter.peer import Peer, PeerIOCallbacks, PeerStateMachine
+from diameter.protocol import DiameterAVP, DiameterMessage
+from diameter.ids import Identifiers
+from diameter.resolver import resolver
+
+
+def newStack():
+    s = stack.Stack()
+    s.identity = "host.example"
+    s.realm = "example"
+    return s
+
+
+def parse(wire):
+    msg = DiameterMessage()
+    msg.parseFromBuffer(wire)
+    return msg
+
+
+class SharedAVPTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = newStack()
+        self.request = self.stack.createRequest(4, 272, auth=True)
+
+    def test_shared_result_code_cannot_change(self):
+        answer = self.stack.createAnswer(self.request, 2001)
+        with self.assertRaises(TypeError):
+            answer.findFirstAVP(268).setInteger32(5012)
+        later = self.stack.createAnswer(self.request, 2001)
+        self.assertEqual(later.findFirstAVP(268).getInteger32(), 2001)
+        self.assertEqual(parse(later.getBytes()).findFirstAVP(268).getInteger32(), 2001)
+
+    def test_shared_origin_host_keeps_framing(self):
+        with self.assertRaises(TypeError):
+            self.request.findFirstAVP(264).setOctetString("a.much.longer.host.example")
+        later = self.stack.createRequest(4, 272, auth=True)
+        wire = later.getBytes()
+        self.assertEqual(later.message_length, len(wire))
+        self.assertEqual(parse(wire).findFirstAVP(264).getOctetString(), "host.example")
+
+    def test_shared_group_children_cannot_change(self):
+        request = self.stack.createRequest(16777238, 272, auth=True, vendor_id=10415)
+        container = request.findFirstAVP(260)
+        with self.assertRaises(TypeError):
+            container.addAVP(DiameterAVP(258).withInteger32(1))
+        with self.assertRaises(TypeError):
+            container.findFirstAVP(266).setInteger32(1)
+
+    def test_copy_can_change(self):
+        answer = self.stack.createAnswer(self.request)
+        shared = self.stack.resultCodeAVP(2001)
+        answer.addAVP(shared.copy().withInteger32(5012))
+        self.assertEqual(parse(answer.getBytes()).findFirstAVP(268).getInteger32(), 5012)
+        self.assertEqual(shared.getInteger32(), 2001)
+        self.assertEqual(self.stack.resultCodeAVP(2001).getWire(), shared.getWire())
+
+
+class ConnectingIO(PeerIOCallbacks):
+    def __init__(self):
+        self.connects = []
+        self.later = []
+
+    def connectV4(self, peer, host, port):
+        self.connects.append((host, port))
+        return "connecting"
+
+    def callSoon(self, callback, *args):
+        self.later.append((callback, args))
+
+
+class ConnectTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = newStack()
+        self.io = ConnectingIO()
+        self.stack.registerPeerIO(self.io)
+        self.lookups = []
+        self.resolveAsync = resolver.resolveAsync
+        resolver.resolveAsync = lambda host, callback=None: self.lookups.append((host, callback))
+        self.resolved = []
+        resolver.resolve = self.resolve
+
+    def tearDown(self):
+        resolver.resolveAsync = self.resolveAsync
+        del resolver.resolve
+        resolver.io_thread = None
+        resolver.cache.pop("peer-host.example", None)
+
+    def resolve(self, host):
+        self.resolved.append((host, threading.current_thread()))
+        addresses = [(socket.AF_INET, socket.inet_aton("192.0.2.2"))]
+        resolver.store(host, addresses, 60)
+        return addresses
+
+    def test_literal_addresses_connect_at_once(self):
+        self.stack.host_addresses = ["127.0.0.1", "::1"]
+        self.assertEqual(self.stack.clientV4Add("192.0.2.1", 3868), "connecting")
+        self.assertEqual(self.io.connects, [("192.0.2.1", 3868)])
+        self.assertEqual(self.lookups, [])
+
+    def test_connect_waits_for_our_addresses(self):
+        self.stack.io_thread = threading.current_thread()
+        self.stack.host_addresses = ["127.0.0.1", "peer-host.example"]
+        self.assertEqual(self.stack.clientV4Add("192.0.2.1", 3868), None)
+        self.assertEqual(self.io.connects, [])
+        self.assertEqual([host for host, callback in self.lookups], ["peer-host.example"])
+
+        resolver.store("peer-host.example", [(socket.AF_INET, socket.inet_aton("192.0.2.2"))], 60)
+        self.lookups[0][1](resolver.cached("peer-host.example"))
+        self.assertEqual(self.io.connects, [])
+        callback, args = self.io.later.pop()
+        callback(*args)
+        self.assertEqual(self.io.connects, [("192.0.2.1", 3868)])
+        self.assertEqual(self.stack.unresolvedAddresses(), [])
+
+    def test_without_io_thread_addresses_are_looked_up_first(self):
+        self.stack.host_addresses = ["peer-host.example"]
+        self.assertEqual(self.stack.clientV4Add("192.0.2.1", 3868), "connecting")
+        self.assertEqual(self.resolved, [("peer-host.example", threading.current_thread())])
+        self.assertEqual(self.lookups, [])
+        self.assertRaises(RuntimeError, self.stack.whenResolved, ["peer-host.example"], self.fail)
+
+    def test_no_dns_wait_on_the_io_thread(self):
+        self.stack.io_thread = resolver.io_thread = threading.current_thread()
+        self.stack.host_addresses = ["127.0.0.1", "peer-host.example"]
+        self.assertRaises(socket.error, DiameterAVP(257).setAddress, "peer-host.example")
+        codes = [(avp.avp_code, avp.getAddress()) for avp in self.stack.capabilitiesAVPs()
+                 if avp.avp_code == 257]
+        self.assertEqual(codes, [(257, "127.0.0.1")])
+        self.assertEqual(self.resolved, [])
+        self.assertEqual([host for host, callback in self.lookups], ["peer-host.example"] * 2)
+
+        resolver.store("peer-host.example", [(socket.AF_INET, socket.inet_aton("192.0.2.2"))], 60)
+        codes = [avp.getAddress() for avp in self.stack.capabilitiesAVPs() if avp.avp_code == 257]
+        self.assertEqual(codes, ["127.0.0.1", "192.0.2.2"])
+
+
+class CapabilitiesAnswerTest(unittest.TestCase):
+    def test_cea_carries_our_addresses(self):
+        server = newStack()
+        server.host_addresses = ["192.0.2.7"]
+        server.registerAuthApplication(object(), 0, 4)
+        io = NullIO()
+        written = []
+        io.write = lambda peer, data, length: written.append(data)
+        server.registerPeerIO(io)
+        client = newStack()
+        client.identity = "client.example"
+        client.registerAuthApplication(object(), 0, 4)
+        cer = client.createRequest(0, 257)
+        for avp in client.capabilitiesAVPs():
+            cer.addAVP(avp)
+        peer = Peer(server.manager, PeerStateMachine.PEER_SERVER)
+        self.assertTrue(peer.receive(cer.getBytes()) > 0)
+        cea = parse(written[0])
+        self.assertEqual(cea.findFirstAVP(268).getInteger32(), 2001)
+        self.assertEqual(cea.findFirstAVP(257).getAddress(), "192.0.2.7")
+        self.assertEqual(cea.findFirstAVP(269).getOctetString(), server.product_name)
+        self.assertEqual([avp.getInteger32() for avp in cea.findAVP(258)], [4])
+
+
+class NullIO(PeerIOCallbacks):
+    def __init__(self):
+        self.aborted = []
+
+    def write(self, peer, data, length):
+        pass
+
+    def abort(self, peer):
+        self.aborted.append(peer)
+
+
+class PeerFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = newStack()
+        self.io = NullIO()
+        self.stack.registerPeerIO(self.io)
+        self.peer = Peer(self.stack.manager, PeerStateMachine.PEER_SERVER)
+        self.stack.registerPeer(self.peer, "peer.example", "example", {(0, 4): True})
+        self.answers = []
+        self.errors = []
+        for n in range(3):
+            self.stack.sendRequestCallback(self.peer, self.stack.createRequest(4, 272, auth=True),
+                                           self.answers.append, self.errors.append, timeout=30)
+        self.stack.sendByPeer(self.peer, self.stack.createRequest(4, 272, auth=True))
+        self.assertEqual(self.peer.outstanding, 4)
+
+    def assertFailedOver(self):
+        self.assertEqual(len(self.errors), 3)
+        for error in self.errors:
+            self.assertTrue(isinstance(error, stack.PeerLost))
+            self.assertTrue(isinstance(error, stack.RequestTimeout))
+        self.assertEqual(self.answers, [])
+        self.assertEqual(len(self.stack.pending), 0)
+        self.assertEqual(self.stack.waiters, {})
+        self.assertEqual(self.peer.outstanding, 0)
+        self.assertEqual(self.stack.manager.selectPeer("example", (0, 4)), None)
+
+    def test_connection_lost(self):
+        self.stack.connectionLost(self.peer)
+        self.assertFailedOver()
+
+    def test_watchdog_down(self):
+        self.stack.peerDown(self.peer)
+        self.assertFailedOver()
+        self.assertEqual(self.io.aborted, [self.peer])
+        # the transport reports the aborted connection as lost too
+        self.stack.connectionLost(self.peer)
+        self.assertEqual(len(self.errors), 3)
+
+
+class PausedRetransmitTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = newStack()
+        self.clock = [0.0]
+        self.stack.timers.clock = lambda: self.clock[0]
+        self.stack.setRetransmitPolicy(4, 3, 1)
+        self.stack.registerPeerIO(NullIO())
+        self.peer = Peer(self.stack.manager, PeerStateMachine.PEER_SERVER)
+        self.stack.registerPeer(self.peer, "peer.example", "example", {(0, 4): True})
+        self.answers = []
+        self.errors = []
+
+    def test_queued_once_and_timed_out(self):
+        self.stack.manager.pauseWriting(self.peer)
+        request = self.stack.createRequest(4, 272, auth=True)
+        self.stack.sendRequestCallback(self.peer, request, self.answers.append, self.errors.append)
+        queue = self.peer.tx_queue
+        for second in range(1, 6):
+            self.clock[0] = second
+            self.stack.timers.run()
+            self.assertTrue(queue.messages.count(request) <= 1)
+        self.assertEqual(len(self.errors), 1)
+        self.assertTrue(isinstance(self.errors[0], stack.RequestTimeout))
+        self.assertEqual(len(self.stack.pending), 0)
+        self.assertEqual(self.peer.outstanding, 0)
+        # given up on, never written once the transport resumes
+        self.assertEqual(queue.messages, [])
+        self.assertEqual(queue.size, 0)
+
+    def test_resumed_before_giving_up(self):
+        self.stack.manager.pauseWriting(self.peer)
+        request = self.stack.createRequest(4, 272, auth=True)
+        self.stack.sendRequestCallback(self.peer, request, self.answers.append, self.errors.append)
+        self.clock[0] = 1
+        self.stack.timers.run()
+        self.stack.manager.resumeWriting(self.peer)
+        self.assertEqual(self.peer.tx_queue.messages, [])
+        self.assertEqual(request.retries, 2)
+        self.assertEqual(self.errors, [])
+        self.assertEqual(len(self.stack.pending), 1)
+
+
+class Recording(stack.ApplicationListener):
+    def __init__(self):
+        self.requests = []
+
+    def onRequest(self, peer, request):
+        self.requests.append(request)
+
+
+class RouteTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = newStack()
+        self.written = []
+        io = NullIO()
+        io.write = lambda peer, data, length: self.written.append(parse(data))
+        self.stack.registerPeerIO(io)
+        self.peer = Peer(self.stack.manager, PeerStateMachine.PEER_SERVER)
+        self.stack.registerPeer(self.peer, "peer.example", "example", {(0, 4): True})
+        self.gx = Recording()
+        self.stack.registerAuthApplication(self.gx, 10415, 16777238)
+        self.cc = Recording()
+        self.stack.registerAuthApplication(self.cc, 0, 4)
+
+    def request(self, application, vendor=None):
+        msg = self.stack.createRequest(application, 272, auth=True, vendor_id=vendor)
+        return parse(msg.getBytes())
+
+    def test_vendor_application(self):
+        self.stack.handleIncomingMessage(self.peer, self.request(16777238, 10415))
+        self.assertEqual(len(self.gx.requests), 1)
+        self.assertEqual(self.written, [])
+
+    def test_vendor_application_without_its_vendor(self):
+        self.stack.handleIncomingMessage(self.peer, self.request(16777238))
+        self.assertEqual(self.gx.requests, [])
+        self.assertEqual(len(self.written), 1)
+        self.assertTrue(self.written[0].error_flag)
+
+    def test_base_application_under_a_vendor(self):
+        self.stack.handleIncomingMessage(self.peer, self.request(4, 10415))
+        self.assertEqual(self.cc.requests, [])
+        self.assertTrue(self.written[0].error_flag)
+        self.stack.handleIncomingMessage(self.peer, self.request(4))
+        self.assertEqual(len(self.cc.requests), 1)
+
+
+class HopByHopTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = newStack()
+        self.stack.registerPeerIO(NullIO())
+        self.peers = []
+        for name in ("a", "b"):
+            peer = Peer(self.stack.manager, PeerStateMachine.PEER_SERVER)
+            peer.hop_by_hop = Identifiers(100)
+            self.stack.registerPeer(peer, name + ".example", "example", {(0, 4): True})
+            self.peers.append(peer)
+
+    def test_numbered_by_the_peer_it_is_sent_to(self):
+        a, b = self.peers
+        bound = self.stack.createRequest(4, 272, auth=True, peer=a)
+        self.assertEqual(bound.hBh, 100)
+        self.stack.sendByPeer(a, bound)
+        self.assertEqual(bound.hBh, 100)
+
+        unbound = self.stack.createRequest(4, 272, auth=True)
+        answers = []
+        self.stack.sendRequestCallback(a, unbound, answers.append, None)
+        self.assertEqual(unbound.hBh, 101)
+        self.assertEqual(sorted(key[1] for key in self.stack.pending.requests), [100, 101])
+
+        # sent again to another peer, numbered by that one
+        self.stack.sendByPeer(b, unbound)
+        self.assertEqual(unbound.hBh, 100)
+        self.assertEqual(len(self.stack.pending), 3)
+
+        self.stack.handleIncomingMessage(a, self.stack.createAnswer(
+            self.stack.createRequest(4, 272, auth=True, peer=a)))
+        self.assertEqual(answers, [])
+
+    def test_answers_keep_the_request_id(self):
+        request = self.stack.createRequest(4, 272, auth=True, peer=self.peers[1])
+        answer = self.stack.createAnswer(request, 2001)
+        self.stack.sendByPeer(self.peers[0], answer)
+        self.assertEqual(answer.hBh, request.hBh)
+
+
+class SessionsTest(unittest.TestCase):
+    def test_enable_twice_sweeps_once(self):
+        s = newStack()
+        clock = [0.0]
+        s.timers.clock = lambda: clock[0]
+        s.enableSessions(idle_timeout=5, interval=1)
+        s.enableSessions(idle_timeout=5, interval=1)
+        self.assertEqual(len(s.timers), 1)
+
+        sweeps = []
+        expire = s.sessions.expire
+        s.sessions.expire = lambda: sweeps.append(clock[0]) or expire()
+        s.sessions.touch("a;1")
+        for t in range(1, 8):
+            clock[0] = t
+            s.timers.run()
+        self.assertEqual(sweeps, [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(len(s.sessions), 0)
+        self.assertEqual(len(s.timers), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+from diameter.timer import TimerQueue
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+class TimerQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.queue = TimerQueue(self.clock)
+        self.fired = []
+
+    def test_fires_in_deadline_order(self):
+        self.queue.schedule(2, self.fired.append, 2)
+        self.queue.schedule(1, self.fired.append, 1)
+        self.queue.schedule(3, self.fired.append, 3)
+        self.clock.time = 2
+        self.assertEqual(self.queue.run(), 2)
+        self.assertEqual(self.fired, [1, 2])
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.nextDeadline(), 3)
+
+    def test_cancel_from_callback(self):
+        later = [self.queue.schedule(10, self.fired.append, n) for n in range(200)]
+
+        def cancelAll():
+            # enough to compact the heap while run() is going through it
+            for timer in later:
+                timer.cancel()
+
+        self.queue.schedule(1, cancelAll)
+        due = [self.queue.schedule(2, self.fired.append, n) for n in range(50)]
+        self.clock.time = 5
+        self.assertEqual(self.queue.run(), 51)
+        self.assertEqual(self.fired, list(range(50)))
+        self.assertEqual(len(self.queue), 0)
+
+        self.clock.time = 20
+        self.assertEqual(self.queue.run(), 0)
+        self.assertEqual(self.fired, list(range(50)))
+        self.assertEqual(self.queue.cancelled, 0)
+        self.assertEqual(self.queue.nextDeadline(), None)
+        for timer in due:
+            timer.cancel()
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.cancelled, 0)
+
+    def test_wakeup_for_earlier_timers(self):
+        woken = []
+        self.queue.wakeup = woken.append
+        self.queue.schedule(5, self.fired.append, 5)
+        self.queue.schedule(7, self.fired.append, 7)
+        self.queue.schedule(2, self.fired.append, 2)
+        self.assertEqual(woken, [5, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
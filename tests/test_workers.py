@@ -0,0 +1,29 @@
+import os
+import signal
+import unittest
+
+from diameter.workers import describeStatus
+
+
+def childStatus(run):
+    pid = os.fork()
+    if not pid:
+        try:
+            run()
+        finally:
+            os._exit(0)
+    return os.waitpid(pid, 0)[1]
+
+
+class DescribeStatusTest(unittest.TestCase):
+    def test_exit_code(self):
+        status = childStatus(lambda: os._exit(3))
+        self.assertEqual(describeStatus(status), "exited with status 3")
+
+    def test_signal(self):
+        status = childStatus(lambda: os.kill(os.getpid(), signal.SIGKILL))
+        self.assertEqual(describeStatus(status), "was killed by signal %d" % signal.SIGKILL)
+
+
+if __name__ == '__main__':
+    unittest.main()